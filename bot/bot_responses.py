@@ -62,6 +62,8 @@ responses = {
         "banned": "Ваш аккаунт заблокирован. 🔒\n Вы больше не можете пользоваться ботом. \n",
         "error": "У вас нет доступа к боту. \n",
     },
+    "stream_placeholder": "🤖 ...",
+    "chat_queue_full": "Слишком много сообщений подряд, дождитесь ответа на предыдущие. ⏳\n",
     "unknown_error": "Неизвестная ошибка, попробуйте позже. 🤖\n",
     "unknown_command": "Неизвестная команда. 🤖\n",
 }
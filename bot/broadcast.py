@@ -0,0 +1,365 @@
+import asyncio
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiogram.utils.exceptions import (
+    NetworkError,
+    RestartingTelegram,
+    RetryAfter,
+    TelegramAPIError,
+)
+from database import db_executor
+from models import BroadcastJob, Message, User
+from sqlalchemy import case, func, select
+
+# namespace of postgres advisory locks held by broadcast workers
+BROADCAST_LOCK_NAMESPACE = 1
+
+_logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by all senders, allows `rate` requests per second
+    with bursts up to `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        # created by the first acquire()
+        self._lock = None
+
+    async def acquire(self):
+        """
+        Wait until request is allowed
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Stop all requests for given time, used for Telegram flood control
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BroadcastStats:
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        # chat ids the message was delivered to
+        self.delivered = set()
+        # chat ids the message can't be delivered to
+        self.undelivered = set()
+        self.started = time.monotonic()
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def rate(self) -> float:
+        """
+        Messages per second since start
+        """
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed else 0.0
+
+
+class Broadcaster:
+    """
+    Send one message to many chats concurrently under a global rate limit
+    """
+
+    def __init__(
+        self,
+        bot,
+        rate: float = 25,
+        concurrency: int = 10,
+        max_retries: int = 3,
+        progress_interval: float = 5,
+        retry_delay: float = 1,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        # seconds to wait before retry after network error, grows linearly
+        self.retry_delay = retry_delay
+
+    async def send(self, chat_id, text: str) -> bool:
+        """
+        Send message, wait and retry on flood control and network errors.
+        Return False if the message was not delivered, errors are never
+        raised, so they don't stop the other senders.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return True
+            except RetryAfter as e:
+                _logger.warning(f"Flood control, broadcast paused for {e.timeout}s")
+                self.bucket.pause(e.timeout)
+            except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+                _logger.warning(f"Broadcast message to {chat_id} failed, retry: {e}")
+                await asyncio.sleep(self.retry_delay * (attempt + 1))
+            except TelegramAPIError as e:
+                # blocked bot, deactivated user, etc. won't succeed on retry
+                _logger.info(f"Broadcast message to {chat_id} failed: {e}")
+                return False
+            except Exception as e:
+                _logger.error(f"Broadcast message to {chat_id} failed: {e}")
+                return False
+        return False
+
+    async def run(
+        self, chat_ids: list, text: str, on_progress=None, stats=None
+    ) -> BroadcastStats:
+        """
+        Send text to all chats, on_progress coroutine is called with stats
+        every progress_interval seconds and when broadcast is done. Given
+        stats are updated, so they are known if sending is interrupted.
+        """
+        if stats is None:
+            stats = BroadcastStats(len(chat_ids))
+        chat_ids = iter(chat_ids)
+
+        async def worker():
+            for chat_id in chat_ids:
+                if await self.send(chat_id, text):
+                    stats.sent += 1
+                    stats.delivered.add(chat_id)
+                else:
+                    stats.failed += 1
+                    stats.undelivered.add(chat_id)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                try:
+                    await on_progress(stats)
+                except Exception as e:
+                    _logger.warning(f"Broadcast progress report failed: {e}")
+
+        reporter_task = asyncio.ensure_future(reporter()) if on_progress else None
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        finally:
+            if reporter_task:
+                reporter_task.cancel()
+        if on_progress:
+            await on_progress(stats)
+        return stats
+
+
+class BroadcastWorker:
+    """
+    Background worker sending persistent broadcast jobs batch by batch.
+    A batch is claimed in a short transaction that leases the job, so no
+    transaction or lock is held while messages are sent and other workers
+    skip the job. The job cursor moves past acknowledged recipients when
+    the batch is recorded. If the worker crashes, the batch is sent again
+    once the lease expires.
+    """
+
+    def __init__(
+        self,
+        broadcaster: Broadcaster,
+        batch_size: int = 100,
+        poll_interval: float = 10,
+        on_progress=None,
+        context_store=None,
+        lease_time: float = 300,
+    ):
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.on_progress = on_progress
+        # delivered messages are added to contexts kept in memory
+        self.context_store = context_store
+        # seconds a claimed batch may take before other workers take the job
+        self.lease_time = lease_time
+        # set by run(), wakeup() does nothing until the worker runs
+        self._wakeup = None
+
+    def wakeup(self):
+        """
+        Start processing new job without waiting for the next poll
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                if await self.process_next_batch():
+                    continue
+            except Exception as e:
+                _logger.error(f"Broadcast batch failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _lock_job(self, db, jobs):
+        """
+        Return first job not claimed by another worker, the lock is
+        released with the transaction
+        """
+        now = datetime.now(timezone.utc)
+        for job in jobs:
+            if job.lease_until and job.lease_until > now:
+                continue
+            locked = db.execute(
+                select(func.pg_try_advisory_xact_lock(BROADCAST_LOCK_NAMESPACE, job.id))
+            ).scalar()
+            if locked:
+                db.refresh(job)
+                if not job.lease_until or job.lease_until <= now:
+                    return job
+        return None
+
+    def claim_batch(self, db):
+        """
+        Claim next batch of the oldest active job, return (job id, text,
+        users) or job status if the job has no recipients left
+        """
+        job = self._lock_job(db, BroadcastJob.get_active_jobs(db))
+        if not job:
+            return None
+        users = User.search_read(
+            db,
+            [
+                ("state", "=", "active"),
+                ("role", "!=", "bot"),
+                ("id", ">", job.last_user_id),
+            ],
+            ["id", "telegram_id", "private_group_id"],
+            limit=self.batch_size,
+            order="id asc",
+        )
+        if not users:
+            job.write(
+                db,
+                {
+                    "state": case(
+                        (BroadcastJob.state == "cancelled", BroadcastJob.state),
+                        else_="done",
+                    )
+                },
+            )
+            return job.get_status()
+        job.write(
+            db,
+            {
+                # job may be cancelled meanwhile
+                "state": case(
+                    (BroadcastJob.state == "pending", "running"),
+                    else_=BroadcastJob.state,
+                ),
+                "lease_until": datetime.now(timezone.utc)
+                + timedelta(seconds=self.lease_time),
+            },
+        )
+        return job.id, job.text, users
+
+    def record_batch(self, db, job_id: int, text: str, users, stats) -> dict:
+        """
+        Store delivered messages of acknowledged users, move job cursor
+        after them, update job counters and release the job
+        """
+        sent = sum(user.telegram_id in stats.delivered for user in users)
+        Message.create_multi(
+            db,
+            [
+                {
+                    "text": text,
+                    "user_id": User.get_bot_id(db),
+                    "group_id": user.private_group_id,
+                }
+                for user in users
+                if user.telegram_id in stats.delivered
+            ],
+        )
+        values = {"lease_until": None}
+        if users:
+            values.update(
+                {
+                    "last_user_id": users[-1].id,
+                    "sent": BroadcastJob.sent + sent,
+                    "failed": BroadcastJob.failed + len(users) - sent,
+                }
+            )
+        job = db.get(BroadcastJob, job_id)
+        job.write(db, values)
+        return job.get_status()
+
+    async def process_next_batch(self) -> bool:
+        """
+        Send next batch of the oldest active job, return False if there
+        is nothing to send
+        """
+        claimed = await db_executor.run(self.claim_batch)
+        if claimed is None:
+            return False
+        if isinstance(claimed, dict):
+            status = claimed
+        else:
+            job_id, text, users = claimed
+            stats = BroadcastStats(len(users))
+            try:
+                await self.broadcaster.run(
+                    [user.telegram_id for user in users], text, stats=stats
+                )
+            finally:
+                # recipients are taken in order, the ones after the first
+                # unprocessed recipient are sent again with the next batch
+                users = list(
+                    itertools.takewhile(
+                        lambda user: user.telegram_id in stats.delivered
+                        or user.telegram_id in stats.undelivered,
+                        users,
+                    )
+                )
+                status = await db_executor.run(
+                    self.record_batch, job_id, text, users, stats
+                )
+            status["rate"] = stats.rate
+            if self.context_store is not None:
+                for user in users:
+                    if user.telegram_id in stats.delivered:
+                        self.context_store.append(
+                            user.private_group_id, "assistant", text
+                        )
+        if self.on_progress:
+            try:
+                await self.on_progress(status)
+            except Exception as e:
+                _logger.warning(f"Broadcast progress report failed: {e}")
+        return True
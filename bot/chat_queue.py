@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+_logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update: types.Update):
+    """
+    Return id of the chat the update belongs to
+    """
+    message = update.message or update.edited_message
+    if message:
+        return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+def is_text_message_update(update: types.Update) -> bool:
+    """
+    Check if update is a text message for the assistant, not a command
+    """
+    message = update.message
+    return bool(message and message.text and not message.text.startswith("/"))
+
+
+class ChatQueue:
+    """
+    Updates of a single chat waiting for their turn
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0
+        # text messages waiting for the lock
+        self.pending_messages = 0
+
+
+class ChatQueueMiddleware(BaseMiddleware):
+    """
+    Process updates of one chat strictly one after another in arrival order,
+    updates of different chats are processed concurrently
+    """
+
+    def __init__(self, max_queue_size: int = 10, on_overflow=None):
+        super().__init__()
+        self.max_queue_size = max_queue_size
+        self.on_overflow = on_overflow
+        self.queues = {}
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat_id = get_update_chat_id(update)
+        if chat_id is None:
+            return
+        queue = self.queues.setdefault(chat_id, ChatQueue())
+        if queue.size >= self.max_queue_size:
+            _logger.warning(f"Update queue of chat {chat_id} is full")
+            if self.on_overflow:
+                await self.on_overflow(chat_id)
+            raise CancelHandler()
+        is_text_message = is_text_message_update(update)
+        queue.size += 1
+        queue.pending_messages += is_text_message
+        try:
+            # asyncio.Lock wakes up waiters in FIFO order
+            await queue.lock.acquire()
+        except BaseException:
+            self._leave(chat_id, queue)
+            raise
+        finally:
+            queue.pending_messages -= is_text_message
+        data["chat_queue_id"] = chat_id
+
+    async def on_post_process_update(
+        self, update: types.Update, result: any, data: dict
+    ):
+        chat_id = data.pop("chat_queue_id", None)
+        if chat_id is None:
+            return
+        queue = self.queues[chat_id]
+        queue.lock.release()
+        self._leave(chat_id, queue)
+
+    def has_pending_messages(self, chat_id) -> bool:
+        """
+        Check if more text messages of the chat are waiting for processing
+        """
+        queue = self.queues.get(chat_id)
+        return bool(queue and queue.pending_messages)
+
+    def _leave(self, chat_id, queue: ChatQueue):
+        queue.size -= 1
+        if not queue.size:
+            del self.queues[chat_id]
@@ -9,5 +9,71 @@ SUPERUSER_ID = int(os.getenv("SUPERUSER_ID"))
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# asyncpg url, derived from DATABASE_URL if not set
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+# use async engine for queries made on the event loop
+DATABASE_ASYNC = ast.literal_eval(os.getenv("DATABASE_ASYNC", "False"))
+# connection pool of sync engine, timeouts in seconds
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = ast.literal_eval(os.getenv("DB_POOL_PRE_PING", "True"))
+# postgres statement_timeout in milliseconds, 0 disables it
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))
+DB_APPLICATION_NAME = os.getenv("DB_APPLICATION_NAME", "chatgpt_telegram_bot")
+# threads running blocking queries of handlers, and calls waiting for them
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 10))
+DB_EXECUTOR_QUEUE_SIZE = int(os.getenv("DB_EXECUTOR_QUEUE_SIZE", 100))
 
 GPT_MODEL = ast.literal_eval(os.getenv("GPT_MODEL"))
+
+OPENAI_REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", 60))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 50))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", 100))
+OPENAI_STREAM = ast.literal_eval(os.getenv("OPENAI_STREAM", "False"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+# answers cached by model settings and context, 0 disables the cache. It is
+# used only with temperature 0 unless OPENAI_CACHE_NONDETERMINISTIC is set.
+OPENAI_CACHE_SIZE = int(os.getenv("OPENAI_CACHE_SIZE", 1000))
+OPENAI_CACHE_TTL = float(os.getenv("OPENAI_CACHE_TTL", 3600))
+OPENAI_CACHE_NONDETERMINISTIC = ast.literal_eval(
+    os.getenv("OPENAI_CACHE_NONDETERMINISTIC", "False")
+)
+# context window of GPT_MODEL in tokens, detected from model name if not set
+GPT_CONTEXT_TOKENS = int(os.getenv("GPT_CONTEXT_TOKENS") or 0) or None
+# max number of latest messages loaded for the context
+GPT_CONTEXT_MESSAGES = int(os.getenv("GPT_CONTEXT_MESSAGES", 100))
+# contexts of active chats kept in memory, least recently active chats are
+# evicted over the limits, 0 bytes disables the store. Contexts are per
+# process, disable it when several webhook workers serve one bot.
+CONTEXT_STORE_SIZE = int(os.getenv("CONTEXT_STORE_SIZE", 10000))
+CONTEXT_STORE_MAX_BYTES = int(os.getenv("CONTEXT_STORE_MAX_BYTES", 0))
+
+# queue chat messages in memory and insert them in batches
+MESSAGE_WRITE_BEHIND = ast.literal_eval(os.getenv("MESSAGE_WRITE_BEHIND", "False"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", 200))
+MESSAGE_FLUSH_BATCH_SIZE = int(os.getenv("MESSAGE_FLUSH_BATCH_SIZE", 100))
+MESSAGE_QUEUE_MAX_SIZE = int(os.getenv("MESSAGE_QUEUE_MAX_SIZE", 10000))
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+# compiled search statements cached by domain shape
+DOMAIN_CACHE_SIZE = int(os.getenv("DOMAIN_CACHE_SIZE", 1000))
+
+# max number of updates of one chat waiting for processing
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", 10))
+# seconds to wait for the next message of a burst before replying, 0 disables
+CHAT_DEBOUNCE_WINDOW = float(os.getenv("CHAT_DEBOUNCE_WINDOW", 0))
+
+# broadcast messages per second, Telegram allows about 30
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+# recipients per batch, progress is saved after every batch
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 100))
+# seconds between checks for new broadcast jobs
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 10))
+
+# public https url of webhook server, long polling is used by main.py
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
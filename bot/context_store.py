@@ -0,0 +1,143 @@
+import sys
+import threading
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional, Tuple
+
+# approximate memory used by a stored message besides its text
+MESSAGE_OVERHEAD = 64
+
+
+class GroupContext:
+    """
+    Latest messages of one group as (role, content) tuples, oldest first
+    """
+
+    __slots__ = ("messages", "size")
+
+    def __init__(self):
+        self.messages = deque()
+        self.size = 0
+
+
+class ContextStore:
+    """
+    Thread-safe in-process store of group contexts. Groups are evicted in
+    least recently used order when the store is over max_groups or its
+    messages take more than max_bytes.
+    """
+
+    def __init__(
+        self, max_groups: int = 10000, max_bytes: int = 0, max_messages: int = 100
+    ):
+        self.max_groups = max_groups
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # group id -> GroupContext
+        self._groups = OrderedDict()
+        # group id -> number of changes while the group is loaded from db
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._groups)
+
+    @staticmethod
+    def _message_size(content: str) -> int:
+        return sys.getsizeof(content) + MESSAGE_OVERHEAD
+
+    def get(self, group_id) -> Optional[List[Tuple[str, str]]]:
+        """
+        Return messages ordered newest to oldest, None if the group must be
+        loaded from database
+        """
+        with self._lock:
+            context = self._groups.get(group_id)
+            if context is None:
+                self.misses += 1
+                self._loading[group_id] = 0
+                return None
+            self._groups.move_to_end(group_id)
+            self.hits += 1
+            return list(reversed(context.messages))
+
+    def load(self, group_id, messages: Iterable[Tuple[str, str]]):
+        """
+        Store messages loaded from database ordered newest to oldest. They
+        are dropped if the group changed since get() missed it.
+        """
+        with self._lock:
+            if self._loading.pop(group_id, 0):
+                return
+            context = GroupContext()
+            self._groups[group_id] = context
+            for role, content in reversed(list(messages)):
+                self._append(context, role, content)
+            self._evict()
+
+    def append(self, group_id, role: str, content: str):
+        """
+        Add the newest message, groups not loaded yet are read from
+        database on the next get()
+        """
+        with self._lock:
+            context = self._groups.get(group_id)
+            if context is None:
+                if group_id in self._loading:
+                    self._loading[group_id] += 1
+                return
+            self._append(context, role, content)
+            self._evict()
+
+    def clear(self, group_id):
+        """
+        Empty group context after reset
+        """
+        with self._lock:
+            if group_id in self._loading:
+                self._loading[group_id] += 1
+            context = self._groups.get(group_id)
+            if context is not None:
+                self.size -= context.size
+                context.messages.clear()
+                context.size = 0
+
+    def invalidate(self, group_id):
+        with self._lock:
+            if group_id in self._loading:
+                self._loading[group_id] += 1
+            context = self._groups.pop(group_id, None)
+            if context is not None:
+                self.size -= context.size
+
+    def _append(self, context: GroupContext, role: str, content: str):
+        context.messages.append((role, content))
+        added = self._message_size(content)
+        context.size += added
+        self.size += added
+        if len(context.messages) > self.max_messages:
+            _role, dropped = context.messages.popleft()
+            removed = self._message_size(dropped)
+            context.size -= removed
+            self.size -= removed
+
+    def _evict(self):
+        while self._groups and (
+            len(self._groups) > self.max_groups or self.size > self.max_bytes
+        ):
+            _group_id, context = self._groups.popitem(last=False)
+            self.size -= context.size
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "groups": len(self._groups),
+            "max_groups": self.max_groups,
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
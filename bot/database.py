@@ -1,22 +1,117 @@
+import asyncio
+import functools
 import logging
-from contextlib import contextmanager
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
-from config import DATABASE_URL
-from sqlalchemy import create_engine
+from config import (
+    ASYNC_DATABASE_URL,
+    DATABASE_URL,
+    DB_APPLICATION_NAME,
+    DB_EXECUTOR_QUEUE_SIZE,
+    DB_EXECUTOR_WORKERS,
+    DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_STATEMENT_TIMEOUT,
+)
+from metrics import Histogram
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 _logger = logging.getLogger(__name__)
 
+
+class PoolMetrics:
+    """
+    Connection pool instrumentation collected from pool events
+    """
+
+    def __init__(self):
+        self.checkout_wait = Histogram()
+        self.connect_time = Histogram()
+
+    def stats(self, pool) -> dict:
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "checkout_wait": self.checkout_wait.stats(),
+            "connect_time": self.connect_time.stats(),
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    Queue pool measuring time spent waiting for a connection
+    """
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            pool_metrics.checkout_wait.observe(time.monotonic() - started)
+
+
+def get_connect_args() -> dict:
+    connect_args = {"application_name": DB_APPLICATION_NAME}
+    if DB_STATEMENT_TIMEOUT:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+    return connect_args
+
+
 # Creating a database engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=InstrumentedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=get_connect_args(),
+)
+
+
+@event.listens_for(engine, "do_connect")
+def on_do_connect(dialect, connection_record, cargs, cparams):
+    connection_record.info["connect_started"] = time.monotonic()
+
+
+@event.listens_for(engine, "connect")
+def on_connect(dbapi_connection, connection_record):
+    started = connection_record.info.pop("connect_started", None)
+    if started is not None:
+        pool_metrics.connect_time.observe(time.monotonic() - started)
+
 
 # Creating a session factory
-SessionLocal = scoped_session(
-    sessionmaker(
-        autocommit=False,
-        autoflush=False,
-        bind=engine,
-    )
+SessionFactory = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=engine,
+)
+SessionLocal = scoped_session(SessionFactory)
+
+# Async engine is created on first use, it requires asyncpg driver
+async_engine = None
+AsyncSessionLocal = sessionmaker(
+    class_=AsyncSession,
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
 )
 
 # Defining a base class for models
@@ -27,8 +122,10 @@ Base = declarative_base()
 def session_scope():
     """
     Provide a transactional scope around a series of operations.
+    Every scope gets its own session, so concurrent handlers on the
+    event loop don't share a transaction.
     """
-    session = SessionLocal()
+    session = SessionFactory()
     try:
         yield session
         session.commit()
@@ -38,3 +135,126 @@ def session_scope():
         raise
     finally:
         session.close()
+
+
+def get_async_database_url(url: str) -> str:
+    """
+    Return database url with asyncpg driver
+    """
+    return re.sub(r"^postgres(ql)?(\+\w+)?://", "postgresql+asyncpg://", url)
+
+
+def get_async_engine():
+    global async_engine
+    if async_engine is None:
+        server_settings = {"application_name": DB_APPLICATION_NAME}
+        if DB_STATEMENT_TIMEOUT:
+            server_settings["statement_timeout"] = str(DB_STATEMENT_TIMEOUT)
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_URL or get_async_database_url(DATABASE_URL),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            connect_args={"server_settings": server_settings},
+        )
+        AsyncSessionLocal.configure(bind=async_engine)
+    return async_engine
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """
+    Provide a transactional scope with AsyncSession, queries don't block
+    the event loop
+    """
+    get_async_engine()
+    session = AsyncSessionLocal()
+    try:
+        yield session
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        _logger.error(f"An error occurred: {e}")
+        raise
+    finally:
+        await session.close()
+
+
+class SessionExecutor:
+    """
+    Bounded thread pool running blocking session work off the event loop.
+    Every call gets its own session_scope, so it must return plain data
+    instead of ORM instances.
+    """
+
+    def __init__(self, max_workers: int = 10, max_queue_size: int = 100):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.queued = 0
+        self.running = 0
+        self.wait_time = Histogram()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="db"
+        )
+        self._lock = threading.Lock()
+        # asyncio primitives are created on first use: they must be bound
+        # to the running event loop, the executor is created at import time
+        self._semaphore = None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Call func(session, *args, **kwargs) in a worker thread, callers
+        over max_queue_size wait on the event loop
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers + self.max_queue_size)
+        async with self._semaphore:
+            submitted = time.monotonic()
+            with self._lock:
+                self.queued += 1
+
+            def call():
+                with self._lock:
+                    self.queued -= 1
+                    self.running += 1
+                self.wait_time.observe(time.monotonic() - submitted)
+                try:
+                    with session_scope() as session:
+                        return func(session, *args, **kwargs)
+                finally:
+                    with self._lock:
+                        self.running -= 1
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, call)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "running": self.running,
+            "queued": self.queued,
+            "wait_time": self.wait_time.stats(),
+        }
+
+
+db_executor = SessionExecutor(
+    max_workers=DB_EXECUTOR_WORKERS, max_queue_size=DB_EXECUTOR_QUEUE_SIZE
+)
+
+
+def run_in_session(func):
+    """
+    Decorator turning function taking session as the first argument into
+    coroutine running in db_executor
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_executor.run(func, *args, **kwargs)
+
+    return wrapper
@@ -1,23 +1,72 @@
 import asyncio
 import logging
+import time
+from typing import Optional
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
+from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import BotCommand
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
 from bot_responses import responses
+from broadcast import Broadcaster, BroadcastWorker
+from chat_queue import ChatQueueMiddleware
 from config import (
+    BROADCAST_BATCH_SIZE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_POLL_INTERVAL,
+    BROADCAST_RATE,
+    CHAT_DEBOUNCE_WINDOW,
+    CHAT_QUEUE_SIZE,
+    CONTEXT_STORE_MAX_BYTES,
+    CONTEXT_STORE_SIZE,
+    DATABASE_ASYNC,
+    GPT_CONTEXT_MESSAGES,
+    GPT_CONTEXT_TOKENS,
     GPT_MODEL,
+    MESSAGE_FLUSH_BATCH_SIZE,
+    MESSAGE_FLUSH_INTERVAL_MS,
+    MESSAGE_QUEUE_MAX_SIZE,
+    MESSAGE_WRITE_BEHIND,
     OPENAI_API_KEY,
+    OPENAI_CACHE_NONDETERMINISTIC,
+    OPENAI_CACHE_SIZE,
+    OPENAI_CACHE_TTL,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_POOL_SIZE,
+    OPENAI_REQUEST_TIMEOUT,
+    OPENAI_STREAM,
+    STREAM_EDIT_INTERVAL,
     SUPERUSER_ID,
     TELEGRAM_ADMIN_BOT_TOKEN,
     TELEGRAM_ADMIN_USER_ID,
     TELEGRAM_MAIN_BOT_TOKEN,
 )
-from database import engine, session_scope
-from models import Base, Message, User
-from openai_agent import OpenAIAgent
+from context_store import ContextStore
+from database import (
+    async_session_scope,
+    db_executor,
+    engine,
+    pool_metrics,
+    run_in_session,
+    session_scope,
+)
+from migrations import lock_schema, upgrade_db
+from models import (
+    Base,
+    BroadcastJob,
+    Group,
+    Message,
+    User,
+    domain_cache,
+    format_context,
+    get_context_role,
+    user_principal_cache,
+)
+from openai_agent import ERROR_RESPONSE, OpenAIAgent
 from sqlalchemy.orm import Session
+from write_behind import MessageWriteBehind
 
 _logger = logging.getLogger(__name__)
 
@@ -31,10 +80,38 @@ admin_bot = Bot(token=TELEGRAM_ADMIN_BOT_TOKEN)
 admin_dp = Dispatcher(admin_bot)
 admin_dp.middleware.setup(LoggingMiddleware())
 
+# sends broadcast messages of admin bot under Telegram rate limits
+broadcaster = Broadcaster(bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+# contexts of active chats, the database is read on cold start only.
+# Other processes don't invalidate it, so it is off unless configured
+context_store = None
+if CONTEXT_STORE_MAX_BYTES:
+    context_store = ContextStore(
+        max_groups=CONTEXT_STORE_SIZE,
+        max_bytes=CONTEXT_STORE_MAX_BYTES,
+        max_messages=GPT_CONTEXT_MESSAGES,
+    )
+# chat messages waiting for batch insert, used if MESSAGE_WRITE_BEHIND is set
+message_queue = MessageWriteBehind(
+    flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000,
+    batch_size=MESSAGE_FLUSH_BATCH_SIZE,
+    max_size=MESSAGE_QUEUE_MAX_SIZE,
+)
+
 # create OpenAI agent
-openai_agent = OpenAIAgent(api_key=OPENAI_API_KEY, settings=GPT_MODEL)
+openai_agent = OpenAIAgent(
+    api_key=OPENAI_API_KEY,
+    settings=GPT_MODEL,
+    request_timeout=OPENAI_REQUEST_TIMEOUT,
+    max_concurrency=OPENAI_MAX_CONCURRENCY,
+    pool_size=OPENAI_POOL_SIZE,
+    context_tokens=GPT_CONTEXT_TOKENS,
+    cache_size=OPENAI_CACHE_SIZE,
+    cache_ttl=OPENAI_CACHE_TTL,
+    cache_nondeterministic=OPENAI_CACHE_NONDETERMINISTIC,
+)
 # create db tables
-Base.metadata.create_all(bind=engine)
+upgrade_db(engine, Base.metadata)
 
 # add available bot commands
 commands = [
@@ -46,34 +123,47 @@ commands = [
 ]
 
 
+async def get_user_principal(telegram_id):
+    """
+    Return cached user data, on cache miss the user is loaded without
+    blocking the event loop
+    """
+    principal = User.get_cached_principal(telegram_id)
+    if principal is not None:
+        return principal
+    if DATABASE_ASYNC:
+        async with async_session_scope() as db_session:
+            return await User.aget_principal(db_session, telegram_id)
+    return await db_executor.run(User.load_principal, telegram_id)
+
+
 # check access to bot
 class UserActivationMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
         """
-        Check user state and save db session to data
+        Check user state, handlers query database through db_executor
         """
-        db_session = session_scope()
         if message.text not in ["/start", "/help"]:
-            user = User.get_user_by_telegram_id(db_session, message.from_user.id)
-            if not user:
-                return await message.answer(responses["access"]["inactive"])
-            if user.state != "active":
-                return await message.answer(responses["access"][user.state])
-        data["db_session"] = db_session
-
-    async def on_post_process_message(
-        self, message: types.Message, data: dict, result: any
-    ):
-        """
-        Closing db session after message processing
-        """
-        db_session = data.pop("db_session", None)
-        if db_session:
-            db_session.close()
+            user = await get_user_principal(message.from_user.id)
+            state = user.state if user else "inactive"
+            if state != "active":
+                await message.answer(responses["access"][state])
+                raise CancelHandler()
 
 
 dp.middleware.setup(UserActivationMiddleware())
 
+
+async def notify_chat_queue_overflow(chat_id):
+    await bot.send_message(chat_id, responses["chat_queue_full"])
+
+
+# updates of one chat are processed in order, different chats in parallel
+chat_queue = ChatQueueMiddleware(
+    max_queue_size=CHAT_QUEUE_SIZE, on_overflow=notify_chat_queue_overflow
+)
+dp.middleware.setup(chat_queue)
+
 # TODO:
 # @dp.my_chat_member_handler()
 # async def bot_chat_member(update: types.ChatMemberUpdated):
@@ -127,25 +217,34 @@ dp.middleware.setup(UserActivationMiddleware())
 # ===========================================
 
 
+@run_in_session
+def register_user(db_session: Session, telegram_id, telegram_username):
+    """
+    Return state of existing user, None if new inactive user is created
+    """
+    user = User.get_user_by_telegram_id(db_session, telegram_id)
+    if user:
+        return user.state
+    User.create(
+        db_session,
+        {"telegram_id": telegram_id, "telegram_username": telegram_username},
+    )
+    return None
+
+
 @dp.message_handler(commands=["start"])
-async def handle_start(message: types.Message, data: dict):
-    db_session = data["db_session"]
+async def handle_start(message: types.Message):
     await bot.set_my_commands(commands)
     try:
-        user = User.get_user_by_telegram_id(db_session, message.from_user.id)
-        if user:
-            response = responses["handle"]["start"][user.state]
+        state = await register_user(message.from_user.id, message.from_user.username)
+        if state:
+            response = responses["handle"]["start"][state]
         else:
             response = responses["handle"]["start"]["new"]
-            values = {
-                "telegram_id": message.from_user.id,
-                "telegram_username": message.from_user.username,
-            }
-            user = User.create(db_session, values)
             await admin_bot.send_message(
                 TELEGRAM_ADMIN_USER_ID,
-                f"New user registration request: {user.telegram_username}. "
-                f"Use /approve {user.telegram_id} to approve.",
+                f"New user registration request: {message.from_user.username}. "
+                f"Use /approve {message.from_user.id} to approve.",
             )
         # send response from bot to user
         await bot.send_message(
@@ -191,11 +290,10 @@ async def reset_context(message: types.Message):
 
 
 @dp.callback_query_handler(lambda c: c.data == "reset_yes")
-async def process_callback_reset_yes(
-    callback_query: types.CallbackQuery, db_session: Session
-):
-    user = User.get_user_by_telegram_id(db_session, message.from_user.id)
-    user.reset_context(db_session)
+async def process_callback_reset_yes(callback_query: types.CallbackQuery):
+    group_id = await reset_user_context(callback_query.from_user.id)
+    if context_store is not None:
+        context_store.clear(group_id)
     await bot.answer_callback_query(
         callback_query.id,
         responses["handle"]["reset_context"]["confirmation"]["confirm"]["answer"],
@@ -218,24 +316,134 @@ async def process_callback_reset_no(callback_query: types.CallbackQuery):
     )
 
 
+async def edit_streamed_message(chat_id, message_id, text: str, wait: bool = False):
+    """
+    Edit streamed message, return seconds to wait before the next edit
+    """
+    try:
+        await bot.edit_message_text(text, chat_id, message_id)
+    except MessageNotModified:
+        pass
+    except RetryAfter as e:
+        if not wait:
+            return e.timeout
+        await asyncio.sleep(e.timeout)
+        return await edit_streamed_message(chat_id, message_id, text, wait=wait)
+    return 0
+
+
+async def send_streamed_response(chat_id, chunks) -> str:
+    """
+    Send placeholder message and edit it in throttled steps while
+    response is being generated, return the final text. The placeholder
+    is replaced with ERROR_RESPONSE if no text was generated.
+    """
+    placeholder = await bot.send_message(chat_id, responses["stream_placeholder"])
+    text = sent_text = ""
+    # first tokens are shown right away, following edits are throttled
+    next_edit = 0
+    async for text in chunks:
+        text = text.strip()
+        if not text or text == sent_text or time.monotonic() < next_edit:
+            continue
+        delay = await edit_streamed_message(chat_id, placeholder.message_id, text)
+        if not delay:
+            sent_text = text
+        next_edit = time.monotonic() + max(delay, STREAM_EDIT_INTERVAL)
+    text = text or ERROR_RESPONSE
+    if text != sent_text:
+        await edit_streamed_message(chat_id, placeholder.message_id, text, wait=True)
+    return text
+
+
+@run_in_session
+def reset_user_context(db_session: Session, telegram_id):
+    # queued messages must be stored before the context marker moves
+    message_queue.flush(db_session)
+    user = User.get_principal(db_session, telegram_id)
+    group = db_session.get(Group, user.private_group_id)
+    group.reset_context(db_session)
+    return group.id
+
+
+@run_in_session
+def save_message(db_session: Session, text: str, author=None, group_id=None):
+    Message.post(db_session, text=text, author=author, group_id=group_id)
+
+
+async def post_message(text: str, author=None, group_id=None):
+    """
+    Save message and add it to the stored context, in write-behind mode
+    it is queued and inserted later
+    """
+    if author:
+        group_id = group_id or author.private_group_id
+    if not MESSAGE_WRITE_BEHIND:
+        await save_message(text, author=author, group_id=group_id)
+    elif author:
+        await message_queue.put(db_executor, text, group_id, author.id, author.role)
+    else:
+        await message_queue.put(db_executor, text, group_id)
+    if context_store is not None:
+        context_store.append(
+            group_id, get_context_role(author.role if author else "bot"), text
+        )
+
+
+@run_in_session
+def load_context_messages(db_session: Session, group_id) -> list:
+    group = db_session.get(Group, group_id)
+    return group.get_context_messages(
+        db_session,
+        limit=GPT_CONTEXT_MESSAGES,
+        message_queue=message_queue if MESSAGE_WRITE_BEHIND else None,
+    )
+
+
+async def get_conversation(group_id) -> list:
+    """
+    Return private group context formatted for ChatGPT, database is read
+    only if the context is not in context_store
+    """
+    if context_store is None:
+        messages = await load_context_messages(group_id)
+    else:
+        messages = context_store.get(group_id)
+        if messages is None:
+            messages = await load_context_messages(group_id)
+            context_store.load(group_id, messages)
+    return format_context(
+        messages,
+        token_limit=openai_agent.context_token_limit,
+        tokenizer=openai_agent.tokenizer,
+    )
+
+
 # handler for text messages
 @dp.message_handler(lambda message: not message.text.startswith("/"))
-async def handle_text_message(message: types.Message, data: dict):
-    db_session = data["db_session"]
-    user = User.get_user_by_telegram_id(db_session, message.from_user.id)
-    Message.post(db_session, author=user, text=message.text)
+async def handle_text_message(message: types.Message):
+    # cached user data, already loaded by UserActivationMiddleware
+    user = await get_user_principal(message.from_user.id)
+    await post_message(message.text, author=user)
     # bot typing
     await bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
-    # get group context with last message
-    group = user.get_private_group(db_session)
+    if CHAT_DEBOUNCE_WINDOW:
+        await asyncio.sleep(CHAT_DEBOUNCE_WINDOW)
+        if chat_queue.has_pending_messages(message.chat.id):
+            # the last message of the burst gets one reply for all of them
+            return
     # prepare context message for ChatGPT
-    context = group.get_format_context(db_session)
-    # send message to ChatGPT
-    response = openai_agent.process_message(context)
+    context = await get_conversation(user.private_group_id)
+    # send message to ChatGPT and response to user
+    if OPENAI_STREAM:
+        response = await send_streamed_response(
+            message.from_user.id, openai_agent.astream_ai_response(context)
+        )
+    else:
+        response = await openai_agent.aprocess_message(context)
+        await bot.send_message(message.from_user.id, response)
     # save bot message to database
-    Message.post(db_session, text=response, group=group)
-    # send response to user
-    await bot.send_message(message.from_user.id, response)
+    await post_message(response, group_id=user.private_group_id)
 
 
 # TODO
@@ -248,27 +456,26 @@ class AdminAccessMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
         if str(message.from_user.id) != TELEGRAM_ADMIN_USER_ID:
             await message.answer(responses["access"]["error"])
-            # TODO: CancelHandler()
             raise CancelHandler()
-        db_session = session_scope()
-        data["db_session"] = db_session
-
-    async def on_post_process_message(
-        self, message: types.Message, data: dict, result: any
-    ):
-        """
-        Closing db session after message processing
-        """
-        db_session = data.pop("db_session", None)
-        if db_session:
-            db_session.close()
 
 
 admin_dp.middleware.setup(AdminAccessMiddleware())
 
 
+@run_in_session
+def find_user_telegram_id(db_session: Session, user_identifier: str):
+    """
+    Return telegram id of user found by telegram id or username
+    """
+    if user_identifier.isdigit():
+        user = User.get_user_by_telegram_id(db_session, user_identifier)
+    else:
+        user = User.get_user_by_telegram_username(db_session, user_identifier)
+    return user.telegram_id if user else None
+
+
 @admin_dp.message_handler(commands=["sendto"])
-async def handle_sendto(message: types.Message, db_session: Session):
+async def handle_sendto(message: types.Message):
     parts = message.text.split(" ", 2)
     if len(parts) <= 2:
         return await message.reply(
@@ -276,23 +483,101 @@ async def handle_sendto(message: types.Message, db_session: Session):
         )
 
     user_identifier, user_message = parts[1], parts[2]
-    if user_identifier.isdigit():
-        user = User.get_user_by_telegram_id(db_session, user_identifier)
-    else:
-        user = User.get_user_by_telegram_username(db_session, user_identifier)
+    telegram_id = await find_user_telegram_id(user_identifier)
 
-    if not user:
+    if not telegram_id:
         return await message.reply(
             f"Пользователь с ID или ником '{user_identifier}' не найден."
         )
-    await bot.send_message(user.telegram_id, user_message)
+    await bot.send_message(telegram_id, user_message)
     await message.reply(f"Сообщение отправлено пользователю {user_identifier}.")
 
 
+BROADCAST_STATES = {
+    "pending": "в очереди",
+    "running": "выполняется",
+    "done": "завершена",
+    "cancelled": "отменена",
+}
+
+
+def format_broadcast_status(status: dict) -> str:
+    text = (
+        f"Рассылка #{status['id']} {BROADCAST_STATES[status['state']]}: "
+        f"отправлено {status['sent']}, ошибок {status['failed']} "
+        f"из {status['total']}"
+    )
+    if status.get("rate"):
+        text += f" ({status['rate']:.1f} сообщений/с)"
+    return text + "."
+
+
+async def report_broadcast_progress(status: dict):
+    if not status["progress_message_id"]:
+        return
+    try:
+        await admin_bot.edit_message_text(
+            format_broadcast_status(status),
+            status["admin_chat_id"],
+            status["progress_message_id"],
+        )
+    except MessageNotModified:
+        pass
+
+
+broadcast_worker = BroadcastWorker(
+    broadcaster,
+    batch_size=BROADCAST_BATCH_SIZE,
+    poll_interval=BROADCAST_POLL_INTERVAL,
+    on_progress=report_broadcast_progress,
+    context_store=context_store,
+)
+
+
+@run_in_session
+def create_broadcast_job(db_session: Session, text: str, admin_chat_id) -> dict:
+    total = User.search_count(
+        db_session, [("state", "=", "active"), ("role", "!=", "bot")]
+    )
+    job = BroadcastJob.create(
+        db_session,
+        {"text": text, "total": total, "admin_chat_id": admin_chat_id},
+    )
+    return job.get_status()
+
+
+@run_in_session
+def set_broadcast_progress_message(db_session: Session, job_id, message_id):
+    job = db_session.get(BroadcastJob, job_id)
+    job.write(db_session, {"progress_message_id": message_id})
+
+
+@run_in_session
+def get_broadcast_status(db_session: Session, job_id=None) -> Optional[dict]:
+    """
+    Return status of given or last broadcast
+    """
+    if job_id:
+        job = db_session.get(BroadcastJob, job_id)
+    else:
+        job = BroadcastJob.get_last_job(db_session)
+    return job.get_status() if job else None
+
+
+@run_in_session
+def cancel_broadcast_job(db_session: Session, job_id) -> Optional[dict]:
+    job = db_session.get(BroadcastJob, job_id)
+    if not job:
+        return None
+    if job.state in ["pending", "running"]:
+        job.write(db_session, {"state": "cancelled"})
+    return job.get_status()
+
+
 @admin_dp.message_handler(commands=["broadcast"])
-async def handle_broadcast(message: types.Message, db_session: Session):
+async def handle_broadcast(message: types.Message):
     """
-    Send message to all active users
+    Create job sending message to all active users
     """
     broadcast_message = message.text.split(" ", 1)
     if len(broadcast_message) <= 1:
@@ -300,14 +585,36 @@ async def handle_broadcast(message: types.Message, db_session: Session):
             "Пожалуйста, укажите сообщение для рассылки после команды."
         )
 
-    broadcast_message = broadcast_message[1]
-    domain = [("state", "=", "active"), ("role", "!=", "bot")]
-    users = User.search(db, domain)
-    for user in users:
-        group = user.get_private_group(db_session)
-        Message.post(db_session, text=response, group=group)
-        await bot.send_message(user.telegram_id, broadcast_message)
-    await message.reply(f"Сообщение отправлено {len(users)} пользователям.")
+    status = await create_broadcast_job(broadcast_message[1], message.chat.id)
+    progress = await message.reply(format_broadcast_status(status))
+    await set_broadcast_progress_message(status["id"], progress.message_id)
+    broadcast_worker.wakeup()
+
+
+@admin_dp.message_handler(commands=["broadcast_status"])
+async def handle_broadcast_status(message: types.Message):
+    """
+    Show progress of given or last broadcast
+    """
+    job_id = message.get_args()
+    status = await get_broadcast_status(int(job_id) if job_id.isdigit() else None)
+    if not status:
+        return await message.reply("Рассылка не найдена.")
+    await message.reply(format_broadcast_status(status))
+
+
+@admin_dp.message_handler(commands=["broadcast_cancel"])
+async def handle_broadcast_cancel(message: types.Message):
+    """
+    Stop broadcast, already sent batches stay delivered
+    """
+    job_id = message.get_args()
+    if not job_id.isdigit():
+        return await message.reply("Пожалуйста, укажите номер рассылки.")
+    status = await cancel_broadcast_job(int(job_id))
+    if not status:
+        return await message.reply("Рассылка не найдена.")
+    await message.reply(format_broadcast_status(status))
 
 
 @admin_dp.message_handler(commands=["sendtochat"])
@@ -330,34 +637,119 @@ async def handle_sendtochat(message: types.Message):
         await message.reply(f"Ошибка при отправке сообщения в чат/канал: {e}")
 
 
+@run_in_session
+def set_user_state(db_session: Session, telegram_id, state: str):
+    """
+    Write user state, return telegram id of the user or None if not found
+    """
+    user = User.get_user_by_telegram_id(db_session, telegram_id)
+    if not user:
+        return None
+    user.write(db_session, {"state": state})
+    return user.telegram_id
+
+
 # TODO: refactoring block and unblock command use /approve and /reject
 @admin_dp.message_handler(lambda message: message.text.startswith("/approve"))
-async def handle_approve(message: types.Message, db_session: Session):
+async def handle_approve(message: types.Message):
     user_id = message.text.split()[1]
     # TODO: or by telegram username
-    user = User.get_user_by_telegram_id(db_session, user_id)
-    if user:
-        user.write({"state": "active"})
+    telegram_id = await set_user_state(user_id, "active")
+    if telegram_id:
+        # new state is committed, cached principal can be dropped
+        User.invalidate_principal(telegram_id)
         await message.reply(f"Пользователь {user_id} был активирован.")
         # TODO: text
-        await bot.send_message(
-            user.telegram_id, "Поздравляю, Ваш аккаунт был активирован!"
-        )
+        await bot.send_message(telegram_id, "Поздравляю, Ваш аккаунт был активирован!")
     else:
-        await message.reply(f"Пользователь {user.telegram_id} не найден.")
+        await message.reply(f"Пользователь {user_id} не найден.")
 
 
 @admin_dp.message_handler(lambda message: message.text.startswith("/reject"))
-async def handle_reject(message: types.Message, db_session: Session):
+async def handle_reject(message: types.Message):
     user_id = message.text.split()[1]
-    user = User.get_user_by_telegram_id(db_session, user_id)
-    if user:
-        user.write({"state": "banned"})
-        await message.reply(f"Пользователь {user.telegram_id} был заблокирован.")
+    telegram_id = await set_user_state(user_id, "banned")
+    if telegram_id:
+        # new state is committed, cached principal can be dropped
+        User.invalidate_principal(telegram_id)
+        await message.reply(f"Пользователь {telegram_id} был заблокирован.")
         # TODO: text
-        await bot.send_message(user.telegram_id, "Ваш аккаунт был заблокирован.")
+        await bot.send_message(telegram_id, "Ваш аккаунт был заблокирован.")
     else:
-        await message.reply(f"Пользователь {user.telegram_id} не найден.")
+        await message.reply(f"Пользователь {user_id} не найден.")
+
+
+@run_in_session
+def count_users(db_session: Session) -> tuple:
+    """
+    Return numbers of active users and users waiting for approval
+    """
+    active_users = User.search_count(
+        db_session, [("state", "=", "active"), ("role", "!=", "bot")]
+    )
+    pending_users = User.search_count(db_session, [("state", "=", "inactive")])
+    return active_users, pending_users
+
+
+def format_stats(active_users: int, pending_users: int) -> str:
+    """
+    Return runtime statistics for admin
+    """
+    user_cache = user_principal_cache.stats()
+    statement_cache = domain_cache.stats()
+    executor = db_executor.stats()
+    pool = pool_metrics.stats(engine.pool)
+    if openai_agent.response_cache is not None:
+        responses_cache = openai_agent.response_cache.stats()
+        response_cache_line = (
+            f"Кэш ответов: {responses_cache['size']}/{responses_cache['maxsize']}, "
+            f"попаданий {responses_cache['hits']}, "
+            f"промахов {responses_cache['misses']} "
+            f"({responses_cache['hit_rate']:.0%})"
+        )
+    else:
+        response_cache_line = "Кэш ответов: выключен"
+    if context_store is not None:
+        contexts = context_store.stats()
+        context_store_line = (
+            f"Контексты в памяти: {contexts['groups']}/{contexts['max_groups']}, "
+            f"{contexts['size'] / 2**20:.1f}/{contexts['max_bytes'] / 2**20:.0f} МБ, "
+            f"попаданий {contexts['hits']}, промахов {contexts['misses']} "
+            f"({contexts['hit_rate']:.0%})"
+        )
+    else:
+        context_store_line = "Контексты в памяти: выключены"
+    return "\n".join(
+        [
+            f"Пользователи: активных {active_users}, ожидают одобрения "
+            f"{pending_users}",
+            f"Кэш пользователей: {user_cache['size']}/{user_cache['maxsize']}, "
+            f"попаданий {user_cache['hits']}, промахов {user_cache['misses']} "
+            f"({user_cache['hit_rate']:.0%})",
+            f"Кэш запросов: {statement_cache['size']}/{statement_cache['maxsize']}, "
+            f"попаданий {statement_cache['hits']}, промахов {statement_cache['misses']} "
+            f"({statement_cache['hit_rate']:.0%})",
+            context_store_line,
+            response_cache_line,
+            f"Очередь сообщений: {len(message_queue)}, "
+            f"отброшено {message_queue.dropped}",
+            f"Потоки БД: {executor['running']}/{executor['workers']} заняты, "
+            f"в очереди {executor['queued']}, ожидание "
+            f"p50 {executor['wait_time']['p50'] * 1000:.0f} мс, "
+            f"p95 {executor['wait_time']['p95'] * 1000:.0f} мс, "
+            f"max {executor['wait_time']['max'] * 1000:.0f} мс",
+            f"Пул соединений: занято {pool['checked_out']}/{pool['size']}, "
+            f"overflow {pool['overflow']}, ожидание "
+            f"p95 {pool['checkout_wait']['p95'] * 1000:.0f} мс, "
+            f"max {pool['checkout_wait']['max'] * 1000:.0f} мс, подключение "
+            f"p95 {pool['connect_time']['p95'] * 1000:.0f} мс",
+        ]
+    )
+
+
+@admin_dp.message_handler(commands=["stats"])
+async def handle_stats(message: types.Message):
+    await message.reply(format_stats(*await count_users()))
 
 
 @admin_dp.message_handler(lambda message: message.text.startswith("/"))
@@ -372,6 +764,8 @@ async def handle_unknown_command(message: types.Message):
 
 def init_db():
     with session_scope() as db_session:
+        # only one of the workers started together creates the bot
+        lock_schema(db_session)
         bot = User.get_user_by_telegram_id(db_session, SUPERUSER_ID)
         if not bot:
             # TODO, create bot with migration
@@ -382,6 +776,8 @@ def init_db():
             }
             bot = User.create(db_session, values)
             bot.state = "active"
+        # resolve bot id once, messages from bot use the cached value
+        User.get_bot_id(db_session)
 
 
 async def start_bot():
@@ -404,8 +800,25 @@ async def start_admin_bot():
         await admin_dp.storage.wait_closed()
 
 
+async def flush_messages():
+    """
+    Store messages left in write-behind queue, used on shutdown
+    """
+    if len(message_queue):
+        await db_executor.run(message_queue.flush)
+
+
 async def main():
-    await asyncio.gather(start_bot(), start_admin_bot())
+    await openai_agent.open()
+    tasks = [start_bot(), start_admin_bot(), broadcast_worker.run()]
+    if MESSAGE_WRITE_BEHIND:
+        tasks.append(message_queue.run(db_executor))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await flush_messages()
+        await openai_agent.close()
+        db_executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import logging
+
+from sqlalchemy import func, select, text
+
+_logger = logging.getLogger(__name__)
+
+# namespace of postgres advisory lock held while database is initialized,
+# broadcast workers use namespace 1
+SCHEMA_LOCK_NAMESPACE = 2
+
+# Idempotent schema changes for databases created by previous versions,
+# new databases get the same schema from Base.metadata.create_all. Each
+# statement runs once per database, new ones must be appended.
+MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_group_id_datetime "
+    "ON messages (group_id, datetime)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS private_group_id INTEGER "
+    "REFERENCES groups (id)",
+    "CREATE INDEX IF NOT EXISTS ix_users_private_group_id "
+    "ON users (private_group_id)",
+    "ALTER TABLE groups ADD COLUMN IF NOT EXISTS context_message_id INTEGER",
+    "UPDATE groups SET context_message_id = 0 WHERE context_message_id IS NULL",
+    "ALTER TABLE groups ALTER COLUMN context_message_id SET DEFAULT 0",
+    "ALTER TABLE groups ALTER COLUMN context_message_id SET NOT NULL",
+    # private group of existing users, the user's own private group
+    # is the oldest one they belong to
+    """
+    UPDATE users SET private_group_id = rels.group_id
+    FROM (
+        SELECT user_group_rels.user_id, min(groups.id) AS group_id
+        FROM user_group_rels
+        JOIN groups ON groups.id = user_group_rels.group_id
+        WHERE groups.type = 'private'
+        GROUP BY user_group_rels.user_id
+    ) AS rels
+    WHERE rels.user_id = users.id AND users.private_group_id IS NULL
+    """,
+]
+
+
+def lock_schema(connection):
+    """
+    Wait for other processes initializing database, the lock is released
+    with the transaction
+    """
+    connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_NAMESPACE, 0)))
+
+
+def upgrade_db(engine, metadata):
+    """
+    Create tables and apply schema changes to existing database. Workers
+    started at the same time run it one after another.
+    """
+    with engine.begin() as connection:
+        lock_schema(connection)
+        metadata.create_all(bind=connection)
+        # number of MIGRATIONS applied to the database
+        connection.execute(
+            text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+        )
+        version = connection.execute(
+            text("SELECT coalesce(max(version), 0) FROM schema_version")
+        ).scalar()
+        for statement in MIGRATIONS[version:]:
+            connection.execute(text(statement))
+        if version < len(MIGRATIONS):
+            connection.execute(text("DELETE FROM schema_version"))
+            connection.execute(
+                text("INSERT INTO schema_version (version) VALUES (:version)"),
+                {"version": len(MIGRATIONS)},
+            )
+    _logger.info("Database schema is up to date")
@@ -1,26 +1,38 @@
 import logging
 import re
-from typing import Any, List, Optional, Tuple, TypeVar
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
 
+from cache import LRUCache
+from config import DOMAIN_CACHE_SIZE, SUPERUSER_ID, USER_CACHE_SIZE, USER_CACHE_TTL
 from sqlalchemy import (
     Column,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     and_,
+    bindparam,
+    insert,
+    literal,
     not_,
     or_,
+    select,
+    true,
+    union_all,
+    update,
 )
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.sql import func
+from tokenizer import trim_conversation
 
-# TODO: from env
-BOT_TELEGRAM_ID = 1
+BOT_TELEGRAM_ID = SUPERUSER_ID
 
 _logger = logging.getLogger(__name__)
 
@@ -45,6 +57,50 @@ ORDER_PATTERN = re.compile(r"(\w+)\s+(asc|desc)", re.I)
 T = TypeVar("T", bound="BaseModel")
 
 
+class UserPrincipal(NamedTuple):
+    """
+    Lightweight user data used for access checks
+    """
+
+    id: int
+    telegram_id: int
+    state: str
+    role: str
+    private_group_id: Optional[int]
+
+
+# telegram id -> UserPrincipal
+user_principal_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# (model, kind, domain shape, options) -> compiled statement
+domain_cache = LRUCache(maxsize=DOMAIN_CACHE_SIZE)
+
+
+def get_context_role(user_role: str) -> str:
+    """
+    Return OpenAI role of messages written by user with given role
+    """
+    return "assistant" if user_role == "bot" else "user"
+
+
+def format_context(
+    messages: List[Tuple[str, str]], token_limit: Optional[int] = None, tokenizer=None
+) -> list:
+    """
+    Build OpenAI conversation from (role, content) ordered newest to oldest
+    """
+    # TODO: get AI role settings from ENV
+    system_message = {
+        "role": "system",
+        "content": "The assistant is helpful, creative, smart and very friendly.",
+    }
+    return trim_conversation(
+        system_message,
+        ({"role": role, "content": content} for role, content in messages),
+        token_limit=token_limit,
+        tokenizer=tokenizer,
+    )
+
+
 class BaseModel(Base):
     __abstract__ = True
 
@@ -55,6 +111,18 @@ class BaseModel(Base):
     def __repr__(self):
         return f"<{self.__tablename__}(id={self.id})>"
 
+    @classmethod
+    def get_column_defaults(cls) -> dict:
+        """
+        Return scalar Column defaults, they are not evaluated for inserts
+        nested in CTEs
+        """
+        return {
+            column.key: column.default.arg
+            for column in cls.__table__.c
+            if column.default is not None and column.default.is_scalar
+        }
+
     def delete(self: T, db: Session):
         """
         Common method to delete record from DB:
@@ -82,6 +150,29 @@ class BaseModel(Base):
             _logger.error(f"An error occurred: {e}")
             raise e
 
+    @classmethod
+    def create_multi(
+        cls, db: Session, values_list: List[dict], batch_size: int = 1000
+    ) -> List[int]:
+        """
+        Insert records with one INSERT ... RETURNING id statement per batch,
+        all values must have the same keys. Return ids of created records.
+        """
+        ids = []
+        try:
+            for start in range(0, len(values_list), batch_size):
+                statement = (
+                    insert(cls)
+                    .values(values_list[start : start + batch_size])
+                    .returning(cls.id)
+                )
+                ids.extend(db.execute(statement).scalars().all())
+            return ids
+        except Exception as e:
+            db.rollback()
+            _logger.error(f"An error occurred: {e}")
+            raise e
+
     def write(self: T, db: Session, values: dict) -> T:
         """
         Common method to update records in DB
@@ -103,25 +194,157 @@ class BaseModel(Base):
             raise e
 
     @classmethod
-    def parse_domain(cls, domain: List, query):
+    def write_multi(cls, db: Session, ids: List[int], values: dict) -> int:
         """
-        Recursive function to parse domain in prefix notation
+        Update records with given ids by one UPDATE statement, relationship
+        fields are not supported. Return number of updated records.
         """
-        if not domain:
-            return []
+        if not ids:
+            return 0
+        try:
+            statement = (
+                update(cls)
+                .where(cls.id.in_(ids))
+                .values(values)
+                .execution_options(synchronize_session="fetch")
+            )
+            return db.execute(statement).rowcount
+        except Exception as e:
+            db.rollback()
+            _logger.error(f"An error occurred: {e}")
+            raise e
 
-        op = domain.pop(0)
-        if op in LOGICAL_OPS:
-            if op == "!":
-                condition = cls.parse_domain(domain, query)
-                return LOGICAL_OPS[op](condition)
-            else:
-                left_condition = cls.parse_domain(domain, query)
-                right_condition = cls.parse_domain(domain, query)
-                return LOGICAL_OPS[op](left_condition, right_condition)
-        else:
-            field, operation, value = op
-            return OPERATIONS[operation](getattr(cls, field), value)
+    @classmethod
+    def parse_domain(cls, domain: List, query=None):
+        """
+        Parse domain in prefix notation into SQL condition with literal
+        values. Expressions left after the first one are joined with AND,
+        the domain itself is not modified.
+        """
+        return cls._parse_domain(domain, lambda index, value: value)
+
+    @classmethod
+    def _parse_domain(cls, domain: List, make_value):
+        conditions = []
+        index = 0
+        while index < len(domain):
+            condition, index = cls._parse_term(domain, index, make_value)
+            conditions.append(condition)
+        return and_(*conditions) if conditions else true()
+
+    @classmethod
+    def _parse_term(cls, domain: List, index: int, make_value):
+        """
+        Recursive function to parse domain expression starting at index,
+        return condition and index of the next expression
+        """
+        term = domain[index]
+        if isinstance(term, str):
+            if term == "!":
+                condition, index = cls._parse_term(domain, index + 1, make_value)
+                return not_(condition), index
+            left_condition, index = cls._parse_term(domain, index + 1, make_value)
+            right_condition, index = cls._parse_term(domain, index, make_value)
+            return LOGICAL_OPS[term](left_condition, right_condition), index
+        field, operation, value = term
+        if value is not None:
+            value = make_value(index, value)
+        return OPERATIONS[operation](getattr(cls, field), value), index + 1
+
+    @classmethod
+    def _compile_statement(cls, kind: str, domain: List, build, **options):
+        """
+        Return statement for domain and its parameters. Statements are
+        cached by domain shape (fields, operations and which values are
+        None), so repeated lookups only bind new values.
+        """
+        shape = tuple(
+            term if isinstance(term, str) else (term[0], term[1], term[2] is None)
+            for term in domain
+        )
+        params = {
+            f"p{index}": list(term[2]) if term[1] == "in" else term[2]
+            for index, term in enumerate(domain)
+            if not isinstance(term, str) and term[2] is not None
+        }
+        key = (cls, kind, shape, tuple(sorted(options.items())))
+        statement = domain_cache.get(key)
+        if statement is None:
+            condition = cls._parse_domain(
+                domain,
+                lambda index, value: bindparam(
+                    f"p{index}", expanding=domain[index][1] == "in"
+                ),
+            )
+            statement = build(condition, **options)
+            domain_cache.set(key, statement)
+        return statement, params
+
+    @classmethod
+    def _order_clauses(cls, order: str) -> list:
+        return [
+            getattr(cls, field).asc()
+            if direction.lower() == "asc"
+            else getattr(cls, field).desc()
+            for field, direction in ORDER_PATTERN.findall(order)
+        ]
+
+    @classmethod
+    def _search_statement(
+        cls,
+        domain: List[Tuple[str, str, Any]],
+        limit: Optional[int] = None,
+        order: Optional[str] = None,
+    ):
+        """
+        Build SELECT statement for search, shared by sync and async sessions
+        """
+
+        def build(condition, limit, order):
+            statement = select(cls).where(condition)
+            if order:
+                statement = statement.order_by(*cls._order_clauses(order))
+            if limit:
+                statement = statement.limit(limit)
+            return statement
+
+        return cls._compile_statement("search", domain, build, limit=limit, order=order)
+
+    @classmethod
+    def _search_read_statement(
+        cls,
+        domain: List[Tuple[str, str, Any]],
+        fields: List[str],
+        limit: Optional[int] = None,
+        order: Optional[str] = None,
+        offset: Optional[int] = None,
+    ):
+        """
+        Build SELECT statement of given columns, shared by sync and async
+        sessions
+        """
+
+        def build(condition, fields, limit, order, offset):
+            statement = select(*[getattr(cls, field) for field in fields]).where(
+                condition
+            )
+            if order:
+                statement = statement.order_by(*cls._order_clauses(order))
+            if offset:
+                statement = statement.offset(offset)
+            if limit:
+                statement = statement.limit(limit)
+            return statement
+
+        return cls._compile_statement(
+            "search_read",
+            domain,
+            build,
+            fields=tuple(fields),
+            limit=limit,
+            order=order,
+            offset=offset,
+        )
 
     @classmethod
     def search(
@@ -134,23 +357,134 @@ class BaseModel(Base):
         """
         Common method to get records from db
         """
-        query = db.query(cls)
-        condition = cls.parse_domain(domain, query)
-        query = query.filter(condition)
+        statement, params = cls._search_statement(domain, limit=limit, order=order)
+        return db.execute(statement, params).scalars().all()
 
-        if limit:
-            query = query.limit(limit)
+    @classmethod
+    def search_read(
+        cls,
+        db: Session,
+        domain: List[Tuple[str, str, Any]],
+        fields: List[str],
+        limit: Optional[int] = None,
+        order: Optional[str] = None,
+        offset: Optional[int] = None,
+    ) -> List[Row]:
+        """
+        Get only given fields of records as rows, no ORM instances are
+        created or tracked by the session
+        """
+        statement, params = cls._search_read_statement(
+            domain, fields, limit=limit, order=order, offset=offset
+        )
+        return db.execute(statement, params).all()
 
-        if order:
-            order_clauses = [
-                getattr(self, field).asc()
-                if direction.lower() == "asc"
-                else getattr(self, field).desc()
-                for field, direction in ORDER_PATTERN.findall(order)
-            ]
-            query = query.order_by(*order_clauses)
+    @classmethod
+    def search_count(cls, db: Session, domain: List[Tuple[str, str, Any]]) -> int:
+        """
+        Return number of records matching domain with SELECT count(*)
+        """
 
-        return query.all()
+        def build(condition):
+            return select(func.count()).select_from(cls).where(condition)
+
+        statement, params = cls._compile_statement("count", domain, build)
+        return db.execute(statement, params).scalar()
+
+    @classmethod
+    def search_exists(cls, db: Session, domain: List[Tuple[str, str, Any]]) -> bool:
+        """
+        Check if any record matches domain with SELECT EXISTS(...)
+        """
+
+        def build(condition):
+            return select(select(cls.id).where(condition).exists())
+
+        statement, params = cls._compile_statement("exists", domain, build)
+        return db.execute(statement, params).scalar()
+
+    @classmethod
+    def iter_search(
+        cls,
+        db: Session,
+        domain: List[Tuple[str, str, Any]],
+        batch_size: int = 1000,
+    ) -> Iterator["BaseModel"]:
+        """
+        Iterate over records ordered by id, fetched in keyset paginated
+        batches through server-side cursor. Memory use doesn't depend on
+        number of matched records as long as the caller doesn't keep them.
+        """
+        last_id = 0
+        while True:
+            statement, params = cls._search_statement(
+                domain + [("id", ">", last_id)], limit=batch_size, order="id asc"
+            )
+            result = db.execute(
+                statement, params, execution_options={"stream_results": True}
+            )
+            count = 0
+            for instance in result.yield_per(batch_size).scalars():
+                count += 1
+                last_id = instance.id
+                yield instance
+            if count < batch_size:
+                return
+
+    # Async variants of common methods for AsyncSession from async_session_scope
+
+    @classmethod
+    async def acreate(cls, db: AsyncSession, values: dict) -> T:
+        instance = cls(**values)
+        try:
+            db.add(instance)
+            await db.flush()
+            return instance
+        except Exception as e:
+            await db.rollback()
+            _logger.error(f"An error occurred: {e}")
+            raise e
+
+    async def awrite(self: T, db: AsyncSession, values: dict) -> T:
+        # relationship fields are lazy loaded, it is allowed only in run_sync
+        return await db.run_sync(lambda session: self.write(session, values))
+
+    async def adelete(self: T, db: AsyncSession):
+        try:
+            await db.delete(self)
+            await db.flush()
+            return True
+        except Exception as e:
+            await db.rollback()
+            _logger.error(f"An error occurred: {e}")
+
+    @classmethod
+    async def asearch(
+        cls,
+        db: AsyncSession,
+        domain: List[Tuple[str, str, Any]],
+        limit: Optional[int] = None,
+        order: Optional[str] = None,
+    ) -> List["BaseModel"]:
+        statement, params = cls._search_statement(domain, limit=limit, order=order)
+        result = await db.execute(statement, params)
+        return result.scalars().all()
+
+    @classmethod
+    async def asearch_read(
+        cls,
+        db: AsyncSession,
+        domain: List[Tuple[str, str, Any]],
+        fields: List[str],
+        limit: Optional[int] = None,
+        order: Optional[str] = None,
+        offset: Optional[int] = None,
+    ) -> List[Row]:
+        statement, params = cls._search_read_statement(
+            domain, fields, limit=limit, order=order, offset=offset
+        )
+        result = await db.execute(statement, params)
+        return result.all()
 
 
 user_group_rels = Table(
@@ -174,20 +508,69 @@ class User(BaseModel):
     role = Column(
         Enum("bot", "user", "admin", name="role"), nullable=False, default="user"
     )
+    private_group_id = Column(
+        Integer, ForeignKey("groups.id"), nullable=True, index=True
+    )
 
     messages = relationship("Message", back_populates="user")
     groups = relationship("Group", secondary=user_group_rels, back_populates="users")
+    private_group = relationship("Group", foreign_keys=[private_group_id])
+
+    # id of ChatGPT Bot, the record never changes after init_db
+    _bot_id = None
 
     @classmethod
     def create(cls, db: Session, values: dict) -> T:
-        new_user = super().create(db, values)
-        new_group = Group.create(
-            db, {"title": f"Private Group for {new_user.telegram_username}"}
+        """
+        Create user with private group in one statement: the group, the
+        user and memberships of the user and ChatGPT Bot are inserted by
+        data-modifying CTEs
+        """
+        group_cte = (
+            insert(Group.__table__)
+            .values(
+                dict(
+                    Group.get_column_defaults(),
+                    title=f"Private Group for {values.get('telegram_username')}",
+                )
+            )
+            .returning(Group.id)
+            .cte("new_group")
         )
-        new_user.write(db, {"groups": new_group})
-        bot = cls.get_bot(db)
-        bot.write(db, {"groups": new_group})
-        db.flush()
+        columns = cls.__table__.c
+        values = dict(cls.get_column_defaults(), **values)
+        user_cte = (
+            insert(cls.__table__)
+            .from_select(
+                [*values, "private_group_id"],
+                select(
+                    *[
+                        literal(value, type_=columns[key].type)
+                        for key, value in values.items()
+                    ],
+                    group_cte.c.id,
+                ),
+            )
+            .returning(*columns)
+            .cte("new_user")
+        )
+        members = select(user_cte.c.id, user_cte.c.private_group_id)
+        bot_id = cls.get_bot_id(db)
+        if bot_id:
+            members = union_all(members, select(literal(bot_id), group_cte.c.id))
+        rels_cte = (
+            insert(user_group_rels)
+            .from_select(["user_id", "group_id"], members)
+            .cte("new_rels")
+        )
+        statement = select(cls).from_statement(select(user_cte).add_cte(rels_cte))
+        try:
+            new_user = db.execute(statement).scalar_one()
+        except Exception as e:
+            db.rollback()
+            _logger.error(f"An error occurred: {e}")
+            raise e
+        cls.invalidate_principal(new_user.telegram_id)
         return new_user
 
     @classmethod
@@ -196,39 +579,115 @@ class User(BaseModel):
         user = User.search(db, domain, limit=1)
         return user[0] if user else None
 
+    @classmethod
+    def get_principal(cls, db: Session, telegram_id) -> Optional[UserPrincipal]:
+        """
+        Return cached lightweight user data by telegram id
+        """
+        return cls.get_cached_principal(telegram_id) or cls.load_principal(
+            db, telegram_id
+        )
+
+    @classmethod
+    def get_cached_principal(cls, telegram_id) -> Optional[UserPrincipal]:
+        """
+        Return user data if it is cached, never queries database
+        """
+        return user_principal_cache.get(int(telegram_id))
+
+    @classmethod
+    def load_principal(cls, db: Session, telegram_id) -> Optional[UserPrincipal]:
+        """
+        Load user data from database and cache it
+        """
+        rows = cls.search_read(
+            db,
+            [("telegram_id", "=", int(telegram_id))],
+            UserPrincipal._fields,
+            limit=1,
+        )
+        return cls._cache_principal(rows[0] if rows else None)
+
+    @classmethod
+    async def aget_principal(
+        cls, db: AsyncSession, telegram_id
+    ) -> Optional[UserPrincipal]:
+        """
+        Async version of get_principal
+        """
+        principal = cls.get_cached_principal(telegram_id)
+        if principal is None:
+            rows = await cls.asearch_read(
+                db,
+                [("telegram_id", "=", int(telegram_id))],
+                UserPrincipal._fields,
+                limit=1,
+            )
+            principal = cls._cache_principal(rows[0] if rows else None)
+        return principal
+
+    @classmethod
+    def _cache_principal(cls, row: Optional[Row]) -> Optional[UserPrincipal]:
+        if not row:
+            return None
+        principal = UserPrincipal(*row)
+        # other processes don't invalidate the cache, users waiting for
+        # approval must see their activation on any of them
+        if principal.state == "active":
+            user_principal_cache.set(principal.telegram_id, principal)
+        return principal
+
+    @classmethod
+    def invalidate_principal(cls, telegram_id):
+        """
+        Drop cached user data, must be called after state or role change
+        """
+        user_principal_cache.invalidate(int(telegram_id))
+
     @classmethod
     def get_user_by_telegram_username(cls, db: Session, telegram_username) -> T:
         domain = [("telegram_username", "=", telegram_username)]
         user = User.search(db, domain, limit=1)
-        return user
+        return user[0] if user else None
 
     def get_private_group(self, db: Session):
         """
         Get the private group associated with the user.
         """
-        group = filter(lambda group: group.type == "private", self.groups)
-        return group[0]
+        return self.private_group
 
     @classmethod
     def get_bot(cls, db: Session):
         """
         Return ChatGPT Bot
         """
-        return User.get_user_by_telegram_id(db, BOT_TELEGRAM_ID)
+        bot_id = cls.get_bot_id(db)
+        return db.get(User, bot_id) if bot_id else None
+
+    @classmethod
+    def get_bot_id(cls, db: Session) -> Optional[int]:
+        """
+        Return id of ChatGPT Bot, resolved once per process
+        """
+        if User._bot_id is None:
+            rows = User.search_read(
+                db, [("telegram_id", "=", BOT_TELEGRAM_ID)], ["id"], limit=1
+            )
+            User._bot_id = rows[0].id if rows else None
+        return User._bot_id
 
     def reset_context(self, db: Session):
         """
         Reset private group context
         """
-        group = user.get_private_group(db)
+        group = self.get_private_group(db)
         group.reset_context(db)
         return True
 
     @classmethod
-    def get_active_users(cls, db: Session):
+    def get_active_users(cls, db: Session) -> Iterator["User"]:
         domain = [("state", "=", "active"), ("role", "!=", "bot")]
-        users = User.search(db, domain)
-        return users
+        return User.iter_search(db, domain)
 
 
 class Message(BaseModel):
@@ -239,33 +698,37 @@ class Message(BaseModel):
     user_id = Column(Integer, ForeignKey("users.id"))
     group_id = Column(Integer, ForeignKey("groups.id"))
 
+    __table_args__ = (Index("ix_messages_group_id_datetime", "group_id", "datetime"),)
+
     user = relationship("User", back_populates="messages")
-    context_group = relationship("Group", back_populates="context_messages")
     group = relationship("Group", back_populates="messages")
 
     @classmethod
     def post(
-        cls, db: Session, text: str, author: "User" = None, group: "Group" = None
+        cls,
+        db: Session,
+        text: str,
+        author: "User" = None,
+        group: "Group" = None,
+        group_id: Optional[int] = None,
     ) -> "Message":
         """
-        Create message record and update group context
+        Create message record and update group context. Author may be a User
+        or UserPrincipal, the message goes to the author's private group
+        if no group is given.
         """
-        group = group or author.get_private_group(db)
-        user = author or User.get_bot(db)
+        if group is not None:
+            group_id = group.id
         message = Message.create(
             db,
             {
                 "text": text,
-                "user_id": user.id,
-                "group_id": group.id,
-            },
-        )
-        group.write(
-            db,
-            {
-                "context_messages": message,
+                "user_id": author.id if author else User.get_bot_id(db),
+                "group_id": group_id or author.private_group_id,
             },
         )
+        if group is not None and group in db:
+            db.expire(group, ["context_messages"])
         return message
 
 
@@ -279,36 +742,130 @@ class Group(BaseModel):
     )
     title = Column(String, nullable=True)
     telegram_username = Column(String, nullable=True)
+    # messages up to this id are left out of the context, 0 if never reset.
+    # It must not be NULL: lazy loader skips the query for NULL parent keys
+    context_message_id = Column(Integer, nullable=False, default=0, server_default="0")
 
     messages = relationship("Message", back_populates="group")
-    context_messages = relationship("Message", back_populates="context_group")
+    context_messages = relationship(
+        "Message",
+        primaryjoin="and_(Group.id == foreign(Message.group_id), "
+        "Group.context_message_id < Message.id)",
+        order_by="Message.id",
+        viewonly=True,
+    )
     users = relationship("User", secondary=user_group_rels, back_populates="groups")
 
     def reset_context(self, db: Session):
         """
-        Reset group context
+        Reset group context, messages posted before are kept in the group
+        but hidden from the context
         """
-        for message in self.context_messages:
-            message.write(db, {"context_group": None})
+        self.write(
+            db,
+            {
+                "context_message_id": func.coalesce(
+                    select(func.max(Message.id)).scalar_subquery(), 0
+                )
+            },
+        )
+        db.expire(self, ["context_messages"])
 
-    def get_format_context(self, db: Session):
+    def get_context_messages(
+        self, db: Session, limit: Optional[int] = None, message_queue=None
+    ) -> List[Tuple[str, str]]:
         """
-        Return list of messages formatted for OpenAI
+        Return (role, content) of the newest context messages ordered newest
+        to oldest. Messages of the group waiting in message_queue
+        (MessageWriteBehind) are added to the stored ones.
         """
-        # TODO: get AI role settings from ENV
-        conversation = [
-            {
-                "role": "system",
-                "content": "The assistant is helpful, creative, smart and very friendly.",
-            }
-        ]
-        conversation.extend(
-            [
-                {
-                    "role": "assistant" if message.user.role == "bot" else "user",
-                    "content": message.text,
-                }
-                for message in self.context_messages
-            ]
+        # text and author role of the newest messages in a single query
+        query = (
+            db.query(Message.id, Message.text, User.role, Message.datetime)
+            .outerjoin(User, Message.user_id == User.id)
+            .filter(
+                Message.group_id == self.id,
+                Message.id > self.context_message_id,
+            )
+            .order_by(Message.datetime.desc(), Message.id.desc())
+            .limit(limit)
+        )
+        if message_queue is None:
+            rows = query.all()
+        else:
+            rows, pending = message_queue.read_with_pending(self.id, query.all)
+            stored_ids = {row.id for row in rows}
+            rows = sorted(
+                rows
+                + [
+                    message
+                    for message in pending
+                    if message.id is None or message.id not in stored_ids
+                ],
+                key=lambda row: row.datetime,
+                reverse=True,
+            )[:limit]
+        # messages without author are posted by ChatGPT Bot
+        return [(get_context_role(row.role or "bot"), row.text) for row in rows]
+
+    def get_format_context(
+        self,
+        db: Session,
+        token_limit: Optional[int] = None,
+        tokenizer=None,
+        limit: Optional[int] = None,
+        message_queue=None,
+    ):
+        """
+        Return list of messages formatted for OpenAI, newest messages that
+        fit in token_limit are kept
+        """
+        messages = self.get_context_messages(
+            db, limit=limit, message_queue=message_queue
         )
-        return conversation
+        return format_context(messages, token_limit=token_limit, tokenizer=tokenizer)
+
+
+class BroadcastJob(BaseModel):
+    __tablename__ = "broadcast_jobs"
+
+    text = Column(String, nullable=False)
+    state = Column(
+        Enum("pending", "running", "done", "cancelled", name="broadcast_state"),
+        nullable=False,
+        default="pending",
+    )
+    # recipients are processed in order of user id, the cursor is the id
+    # of the last user of the last acknowledged batch
+    last_user_id = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    admin_chat_id = Column(Integer, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+    # a worker is sending the claimed batch until this time
+    lease_until = Column(DateTime(timezone=True), nullable=True)
+
+    def get_status(self) -> dict:
+        """
+        Return job progress as plain data, usable after session is closed
+        """
+        return {
+            "id": self.id,
+            "state": self.state,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "admin_chat_id": self.admin_chat_id,
+            "progress_message_id": self.progress_message_id,
+        }
+
+    @classmethod
+    def get_active_jobs(cls, db: Session) -> List["BroadcastJob"]:
+        domain = [("state", "in", ["pending", "running"])]
+        return cls.search(db, domain, order="id asc")
+
+    @classmethod
+    def get_last_job(cls, db: Session) -> Optional["BroadcastJob"]:
+        jobs = cls.search(db, [("id", ">", 0)], limit=1, order="id desc")
+        return jobs[0] if jobs else None
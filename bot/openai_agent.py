@@ -1,8 +1,30 @@
+import asyncio
+import hashlib
+import json
+
+import aiohttp
 import openai
+from cache import LRUCache
+from tokenizer import get_context_token_limit, get_tokenizer
+
+ERROR_RESPONSE = "Sorry, I'm having some trouble right now. Please try again later."
+# added to streamed response interrupted by an error
+TRUNCATED_RESPONSE = "\n\n[The response was interrupted.]"
 
 
 class OpenAIAgent:
-    def __init__(self, api_key, settings=None):
+    def __init__(
+        self,
+        api_key,
+        settings=None,
+        request_timeout=60,
+        max_concurrency=50,
+        pool_size=100,
+        context_tokens=None,
+        cache_size=0,
+        cache_ttl=3600,
+        cache_nondeterministic=False,
+    ):
         openai.api_key = api_key
         self.settings = settings or {
             "model": "gpt-3.5-turbo",
@@ -10,6 +32,61 @@ class OpenAIAgent:
             "max_tokens": 300,
             "stop": ["assistant", "user"],
         }
+        self.tokenizer = get_tokenizer(self.settings.get("model", ""))
+        self.context_token_limit = get_context_token_limit(
+            self.settings, context_tokens
+        )
+        self.request_timeout = request_timeout
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        # identical contexts get the same answer only if the model is
+        # deterministic or sampled answers are allowed to repeat
+        self.response_cache = None
+        if cache_size and (
+            self.settings.get("temperature") == 0 or cache_nondeterministic
+        ):
+            self.response_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # created by open()
+        self._session = None
+        self._semaphore = None
+
+    async def open(self):
+        """
+        Create shared keep-alive HTTP connection pool for async requests
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        """
+        Close shared HTTP connection pool
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def get_cache_key(self, conversation: list) -> str:
+        """
+        Return stable hash of model settings and conversation
+        """
+        data = json.dumps(
+            {"settings": self.settings, "messages": conversation},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get_cached_response(self, conversation: list):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(self.get_cache_key(conversation))
+
+    def cache_response(self, conversation: list, response: str):
+        if self.response_cache is not None and response != ERROR_RESPONSE:
+            self.response_cache.set(self.get_cache_key(conversation), response)
 
     def process_message(self, conversation_context) -> str:
         # Retrieve AI's response from OpenAI API
@@ -17,14 +94,85 @@ class OpenAIAgent:
         # Return AI's response
         return response
 
+    async def aprocess_message(self, conversation_context) -> str:
+        """
+        Non-blocking version of process_message for use inside handlers
+        """
+        return await self.aget_ai_response(conversation_context)
+
     def get_ai_response(self, conversation: list) -> str:
+        cached = self.get_cached_response(conversation)
+        if cached is not None:
+            return cached
         try:
             # Generate AI's response using OpenAI API
             response = openai.ChatCompletion.create(
-                messages=conversation, **self.settings
+                messages=conversation,
+                request_timeout=self.request_timeout,
+                **self.settings,
             )
             # Extract AI's response from the API response
-            return response.choices[0].message.content.strip()
+            text = response.choices[0].message.content.strip()
+            self.cache_response(conversation, text)
+            return text
         except Exception as e:
             print(f"Error while getting response from OpenAI: {e}")
-            return "Sorry, I'm having some trouble right now. Please try again later."
+            return ERROR_RESPONSE
+
+    async def aget_ai_response(self, conversation: list) -> str:
+        cached = self.get_cached_response(conversation)
+        if cached is not None:
+            return cached
+        await self.open()
+        try:
+            async with self._semaphore:
+                # openai reads the client session from a context variable,
+                # set it for the current task so the pool is reused
+                openai.aiosession.set(self._session)
+                response = await openai.ChatCompletion.acreate(
+                    messages=conversation,
+                    request_timeout=self.request_timeout,
+                    **self.settings,
+                )
+            text = response.choices[0].message.content.strip()
+            self.cache_response(conversation, text)
+            return text
+        except Exception as e:
+            print(f"Error while getting response from OpenAI: {e}")
+            return ERROR_RESPONSE
+
+    async def astream_ai_response(self, conversation: list):
+        """
+        Yield AI's response text accumulated so far while tokens arrive.
+        The last text is ERROR_RESPONSE if nothing was received and ends
+        with TRUNCATED_RESPONSE if the stream failed.
+        """
+        cached = self.get_cached_response(conversation)
+        if cached is not None:
+            yield cached
+            return
+        await self.open()
+        text = ""
+        try:
+            async with self._semaphore:
+                openai.aiosession.set(self._session)
+                response = await openai.ChatCompletion.acreate(
+                    messages=conversation,
+                    request_timeout=self.request_timeout,
+                    stream=True,
+                    **self.settings,
+                )
+                async for chunk in response:
+                    delta = chunk.choices[0].delta.get("content")
+                    if delta:
+                        text += delta
+                        yield text
+        except Exception as e:
+            print(f"Error while streaming response from OpenAI: {e}")
+            yield text + TRUNCATED_RESPONSE if text.strip() else ERROR_RESPONSE
+            return
+        if not text.strip():
+            yield ERROR_RESPONSE
+            return
+        # only complete answers are cached
+        self.cache_response(conversation, text.strip())
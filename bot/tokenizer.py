@@ -0,0 +1,100 @@
+import os
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# context window of known models, matched by name prefix
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo": 4096,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+# chat format overhead for every message and for priming the reply
+MESSAGE_TOKENS = 4
+REPLY_TOKENS = 3
+
+
+class ApproximateTokenizer:
+    """
+    Fast estimate of token count, about 4 bytes of UTF-8 per token
+    """
+
+    def count(self, text: str) -> int:
+        return len(text.encode("utf-8")) // 4 + 1
+
+
+class TiktokenTokenizer:
+    """
+    Exact token count using tiktoken encodings
+    """
+
+    def __init__(self, model: str):
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+
+def get_tokenizer(model: str):
+    """
+    Return tiktoken tokenizer if encodings are cached in TIKTOKEN_CACHE_DIR,
+    approximate otherwise. tiktoken downloads missing encodings without
+    timeout, so it is not used without a local cache.
+    """
+    cache_dir = os.getenv("TIKTOKEN_CACHE_DIR")
+    if tiktoken is not None and cache_dir and os.path.isdir(cache_dir):
+        try:
+            if os.listdir(cache_dir):
+                return TiktokenTokenizer(model)
+        except Exception:
+            # unreadable cache or broken encoding file
+            pass
+    return ApproximateTokenizer()
+
+
+def get_context_token_limit(settings: dict, context_tokens: int = None) -> int:
+    """
+    Return number of tokens available for the prompt: model context window
+    without tokens reserved for the reply
+    """
+    if not context_tokens:
+        model = settings.get("model", "")
+        context_tokens = next(
+            (
+                tokens
+                for name, tokens in MODEL_CONTEXT_TOKENS.items()
+                if model.startswith(name)
+            ),
+            DEFAULT_CONTEXT_TOKENS,
+        )
+    return context_tokens - settings.get("max_tokens", 0) - REPLY_TOKENS
+
+
+def trim_conversation(
+    system_message: dict, messages, token_limit: int = None, tokenizer=None
+) -> list:
+    """
+    Build conversation from messages ordered newest to oldest. The system
+    message and the newest message are always kept, older messages are
+    added while they fit in token_limit.
+    """
+    tokenizer = tokenizer or ApproximateTokenizer()
+    used = MESSAGE_TOKENS + tokenizer.count(system_message["content"])
+    conversation = []
+    for message in messages:
+        if token_limit is not None:
+            used += MESSAGE_TOKENS + tokenizer.count(message["content"])
+            if conversation and used > token_limit:
+                break
+        conversation.append(message)
+    conversation.append(system_message)
+    conversation.reverse()
+    return conversation
@@ -0,0 +1,110 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram import Bot, Dispatcher, types
+from config import MESSAGE_WRITE_BEHIND, WEBHOOK_SECRET, WEBHOOK_URL
+from database import db_executor
+from fastapi import FastAPI, HTTPException, Request, Response
+from main import (
+    admin_dp,
+    broadcast_worker,
+    dp,
+    flush_messages,
+    init_db,
+    message_queue,
+    openai_agent,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Webhook mode, run with several processes:
+#   uvicorn webhook:app --app-dir bot --workers 4
+app = FastAPI()
+
+DISPATCHERS = {
+    "main": dp,
+    "admin": admin_dp,
+}
+
+# keep references to running tasks, so they are not garbage collected
+background_tasks = set()
+# seconds to wait for updates being processed on shutdown
+SHUTDOWN_TIMEOUT = 30
+
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def process_update(dispatcher: Dispatcher, update: types.Update):
+    """
+    Feed update into dispatcher the same way long polling does
+    """
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    try:
+        # process_update() alone skips the update middlewares (chat queue)
+        await dispatcher.process_updates([update])
+    except Exception as e:
+        _logger.error(f"Error processing update {update.update_id}: {e}")
+
+
+@app.post("/webhook/{bot_name}")
+async def handle_webhook(bot_name: str, request: Request):
+    """
+    Receive Telegram update and acknowledge it before processing
+    """
+    dispatcher = DISPATCHERS.get(bot_name)
+    if dispatcher is None:
+        raise HTTPException(status_code=404)
+    secret_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # without configured secret anybody could post forged updates
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret_token, WEBHOOK_SECRET):
+        raise HTTPException(status_code=403)
+    update = types.Update(**(await request.json()))
+    run_in_background(process_update(dispatcher, update))
+    return Response(status_code=200)
+
+
+@app.on_event("startup")
+async def on_startup():
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to run webhook mode")
+    init_db()
+    await openai_agent.open()
+    if WEBHOOK_URL:
+        for bot_name, dispatcher in DISPATCHERS.items():
+            # aiogram 2 has no secret_token argument in set_webhook
+            await dispatcher.bot.request(
+                "setWebhook",
+                {
+                    "url": f"{WEBHOOK_URL}/webhook/{bot_name}",
+                    "secret_token": WEBHOOK_SECRET,
+                },
+            )
+    # jobs are locked in the database, one worker per process is safe
+    app.state.broadcast_task = asyncio.ensure_future(broadcast_worker.run())
+    app.state.message_flush_task = None
+    if MESSAGE_WRITE_BEHIND:
+        app.state.message_flush_task = asyncio.ensure_future(
+            message_queue.run(db_executor)
+        )
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.broadcast_task.cancel()
+    # finish updates already acknowledged to Telegram
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=SHUTDOWN_TIMEOUT)
+    if app.state.message_flush_task:
+        app.state.message_flush_task.cancel()
+    await flush_messages()
+    await openai_agent.close()
+    for dispatcher in DISPATCHERS.values():
+        session = await dispatcher.bot.get_session()
+        await session.close()
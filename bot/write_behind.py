@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from models import Message, User
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+_logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    """
+    Message waiting for insert, id is set once the row is inserted
+    """
+
+    __slots__ = ("text", "user_id", "group_id", "role", "datetime", "id")
+
+    def __init__(self, text: str, group_id: int, user_id: Optional[int], role: str):
+        self.text = text
+        self.group_id = group_id
+        self.user_id = user_id
+        self.role = role
+        # set here, so the row keeps the order and time the message arrived
+        self.datetime = datetime.now(timezone.utc)
+        self.id = None
+
+
+class MessageWriteBehind:
+    """
+    Ordered in-process queue of chat messages inserted in batches every
+    flush_interval seconds or as soon as batch_size messages are waiting.
+    Messages stay visible to the context readers until they are committed.
+    Callers of put() wait for a flush while max_size messages are queued.
+    """
+
+    def __init__(
+        self, flush_interval: float = 0.2, batch_size: int = 100, max_size: int = 0
+    ):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.flushes = 0
+        self.dropped = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        # only one thread inserts messages at a time
+        self._flush_lock = threading.Lock()
+        # set by run(), until then add() doesn't trigger flushes
+        self._wakeup = None
+
+    def add(
+        self, text: str, group_id: int, user_id: Optional[int] = None, role="bot"
+    ) -> PendingMessage:
+        """
+        Queue message, messages without user_id are posted by ChatGPT Bot
+        """
+        message = PendingMessage(text, group_id, user_id, role)
+        with self._lock:
+            self._queue.append(message)
+            size = len(self._queue)
+        if size >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+        return message
+
+    async def put(
+        self,
+        executor,
+        text: str,
+        group_id: int,
+        user_id: Optional[int] = None,
+        role="bot",
+    ) -> PendingMessage:
+        """
+        Queue message, if the queue is full it is flushed in executor first
+        """
+        if self.max_size and len(self._queue) >= self.max_size:
+            await executor.run(self.flush)
+        return self.add(text, group_id, user_id, role)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def pending(self, group_id: int) -> list:
+        with self._lock:
+            return [message for message in self._queue if message.group_id == group_id]
+
+    def read_with_pending(self, group_id: int, read):
+        """
+        Call read() and return its result with messages of the group not
+        flushed yet. read() is repeated if a flush was committed meanwhile,
+        pending messages with id may be in the result already.
+        """
+        while True:
+            flushes = self.flushes
+            result = read()
+            with self._lock:
+                if self.flushes == flushes:
+                    return result, [
+                        message
+                        for message in self._queue
+                        if message.group_id == group_id
+                    ]
+
+    def _insert(self, db: Session, messages: list, bot_id: Optional[int]):
+        """
+        Insert and commit messages, ids are set if they are committed
+        """
+        try:
+            ids = Message.create_multi(
+                db,
+                [
+                    {
+                        "text": message.text,
+                        "user_id": message.user_id or bot_id,
+                        "group_id": message.group_id,
+                        "datetime": message.datetime,
+                    }
+                    for message in messages
+                ],
+                batch_size=self.batch_size,
+            )
+            with self._lock:
+                for message, message_id in zip(messages, ids):
+                    message.id = message_id
+            db.commit()
+        except Exception:
+            with self._lock:
+                for message in messages:
+                    message.id = None
+            raise
+
+    def _remove(self, count: int):
+        with self._lock:
+            # new messages are only appended, the batch is at the front
+            for _index in range(count):
+                self._queue.popleft()
+            self.flushes += 1
+
+    def flush(self, db: Session) -> int:
+        """
+        Insert and commit all queued messages, return number of inserted
+        ones. If the database rejects the batch, messages are inserted one
+        by one and the rejected ones are dropped, so they don't block the
+        queue. Other errors keep all messages queued.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._queue)
+            if not batch:
+                return 0
+            bot_id = User.get_bot_id(db)
+            try:
+                self._insert(db, batch, bot_id)
+            except (DataError, IntegrityError) as e:
+                _logger.error(f"Message batch rejected, inserting one by one: {e}")
+            else:
+                self._remove(len(batch))
+                return len(batch)
+            inserted = 0
+            for index, message in enumerate(batch):
+                try:
+                    self._insert(db, [message], bot_id)
+                    inserted += 1
+                except (DataError, IntegrityError) as e:
+                    self.dropped += 1
+                    _logger.error(f"Message of group {message.group_id} dropped: {e}")
+                except Exception:
+                    self._remove(index)
+                    raise
+            self._remove(len(batch))
+            return inserted
+
+    async def run(self, executor):
+        """
+        Flush messages in executor until cancelled
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._queue:
+                continue
+            try:
+                await executor.run(self.flush)
+            except Exception as e:
+                _logger.error(f"Message flush failed, retrying later: {e}")
@@ -1,2 +1,11 @@
 from . import test_models
 from . import test_main
+from . import test_cache
+from . import test_chat_queue
+from . import test_broadcast
+from . import test_webhook
+from . import test_database
+from . import test_write_behind
+from . import test_context_store
+from . import test_openai_agent
+from . import test_tokenizer
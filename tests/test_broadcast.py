@@ -0,0 +1,122 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    NetworkError,
+    RestartingTelegram,
+    RetryAfter,
+)
+
+from bot.broadcast import Broadcaster, BroadcastStats, BroadcastWorker
+from bot.models import BroadcastJob, Message, User
+
+from .common import db_session, fake_bot  # noqa: F401
+from .test_models import create_user
+
+
+@pytest.mark.asyncio
+async def test_broadcast_sends_to_all_chats(fake_bot):  # noqa: F811
+    broadcaster = Broadcaster(fake_bot, rate=1000, concurrency=3)
+    stats = await broadcaster.run(list(range(10)), "Hello")
+    assert stats.sent == 10
+    assert stats.failed == 0
+    assert fake_bot.send_message.await_count == 10
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_after_and_errors(fake_bot):  # noqa: F811
+    fake_bot.send_message.side_effect = [
+        RetryAfter(0),
+        None,
+        BotBlocked("Forbidden: bot was blocked by the user"),
+    ]
+    on_progress = AsyncMock()
+    broadcaster = Broadcaster(fake_bot, rate=1000, concurrency=1)
+    stats = await broadcaster.run([1, 2], "Hello", on_progress=on_progress)
+    assert stats.sent == 1
+    assert stats.failed == 1
+    assert fake_bot.send_message.await_count == 3
+    on_progress.assert_awaited_with(stats)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retries_transient_errors(fake_bot):  # noqa: F811
+    fake_bot.send_message.side_effect = [
+        NetworkError("Connection reset"),
+        asyncio.TimeoutError(),
+        RestartingTelegram(),
+        None,
+        ValueError("Unexpected"),
+        None,
+    ]
+    broadcaster = Broadcaster(fake_bot, rate=1000, concurrency=1, retry_delay=0)
+    stats = await broadcaster.run([1, 2, 3], "Hello")
+    # unexpected error fails one recipient only
+    assert (stats.sent, stats.failed) == (2, 1)
+    assert stats.delivered == {1, 3}
+    assert fake_bot.send_message.await_count == 6
+
+
+def test_broadcast_worker_claims_batch(db_session, fake_bot):  # noqa: F811
+    user = create_user(db_session)
+    job = BroadcastJob.create(db_session, {"text": "News"})
+    worker = BroadcastWorker(Broadcaster(fake_bot), batch_size=1000)
+
+    job_id, text, users = worker.claim_batch(db_session)
+    assert (job_id, text) == (job.id, "News")
+    assert user.id in [row.id for row in users]
+    db_session.refresh(job)
+    assert job.state == "running"
+    # cursor moves when the batch is acknowledged
+    assert job.last_user_id == 0
+    # the job is leased while the batch is being sent
+    assert job.lease_until is not None
+    assert worker.claim_batch(db_session) is None
+
+    stats = BroadcastStats(len(users))
+    stats.sent = 1
+    stats.failed = len(users) - 1
+    stats.delivered = {user.telegram_id}
+    status = worker.record_batch(db_session, job_id, text, users, stats)
+    assert status["sent"] == 1
+    # only delivered messages are stored
+    assert Message.search_count(db_session, [("text", "=", "News")]) == 1
+    db_session.refresh(job)
+    assert job.lease_until is None
+    assert job.last_user_id == users[-1].id
+    assert worker.claim_batch(db_session)["state"] == "done"
+
+
+@pytest.mark.asyncio
+async def test_broadcast_worker_records_interrupted_batch(
+    db_session, fake_bot  # noqa: F811
+):
+    create_user(db_session)
+    User.create(db_session, {"telegram_id": 654321, "state": "active"})
+    job = BroadcastJob.create(db_session, {"text": "News"})
+    worker = BroadcastWorker(Broadcaster(fake_bot), batch_size=1000)
+    sent_to = []
+
+    async def run(chat_ids, text, stats):
+        # the second send of the batch times out
+        sent_to.append(chat_ids[0])
+        stats.delivered.add(chat_ids[0])
+        raise asyncio.TimeoutError()
+
+    async def run_in_session(func, *args):
+        return func(db_session, *args)
+
+    with patch.object(worker.broadcaster, "run", run), patch(
+        "bot.broadcast.db_executor", AsyncMock(run=run_in_session)
+    ):
+        with pytest.raises(asyncio.TimeoutError):
+            await worker.process_next_batch()
+
+    db_session.refresh(job)
+    # the job resumes after the acknowledged recipient
+    assert (job.sent, job.failed) == (1, 0)
+    assert job.lease_until is None
+    assert job.last_user_id == User.get_user_by_telegram_id(db_session, sent_to[0]).id
+    assert Message.search_count(db_session, [("text", "=", "News")]) == 1
@@ -0,0 +1,38 @@
+from unittest.mock import patch
+
+from bot.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_ttl_expiration():
+    cache = LRUCache(maxsize=10, ttl=60)
+    with patch("bot.cache.time.monotonic", return_value=100):
+        cache.set("a", 1)
+    with patch("bot.cache.time.monotonic", return_value=159):
+        assert cache.get("a") == 1
+    with patch("bot.cache.time.monotonic", return_value=161):
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_invalidate_and_stats():
+    cache = LRUCache(maxsize=10)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
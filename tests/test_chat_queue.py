@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+
+from bot.chat_queue import ChatQueueMiddleware
+
+
+def make_update(update_id, chat_id, text="Hello"):
+    return types.Update.to_object(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            },
+        }
+    )
+
+
+async def process(middleware, events, update):
+    data = {}
+    await middleware.on_pre_process_update(update, data)
+    events.append(("start", update.update_id))
+    await asyncio.sleep(0.01)
+    events.append(("end", update.update_id))
+    await middleware.on_post_process_update(update, [], data)
+
+
+@pytest.mark.asyncio
+async def test_chat_updates_are_serialized():
+    middleware = ChatQueueMiddleware(max_queue_size=10)
+    events = []
+    await asyncio.gather(
+        process(middleware, events, make_update(1, 100)),
+        process(middleware, events, make_update(2, 100)),
+        process(middleware, events, make_update(3, 200)),
+    )
+    # updates of one chat don't overlap and keep arrival order
+    assert events.index(("end", 1)) < events.index(("start", 2))
+    # other chats are not blocked
+    assert events.index(("start", 3)) < events.index(("end", 1))
+    assert middleware.queues == {}
+
+
+@pytest.mark.asyncio
+async def test_chat_queue_overflow():
+    overflow = []
+
+    async def on_overflow(chat_id):
+        overflow.append(chat_id)
+
+    middleware = ChatQueueMiddleware(max_queue_size=1, on_overflow=on_overflow)
+    data = {}
+    await middleware.on_pre_process_update(make_update(1, 100), data)
+    with pytest.raises(CancelHandler):
+        await middleware.on_pre_process_update(make_update(2, 100), {})
+    assert overflow == [100]
+    await middleware.on_post_process_update(make_update(1, 100), [], data)
+    assert middleware.queues == {}
+
+
+@pytest.mark.asyncio
+async def test_has_pending_messages():
+    middleware = ChatQueueMiddleware(max_queue_size=10)
+    data = {}
+    await middleware.on_pre_process_update(make_update(1, 100), data)
+    assert not middleware.has_pending_messages(100)
+
+    command_data = {}
+    command = asyncio.ensure_future(
+        middleware.on_pre_process_update(make_update(2, 100, "/help"), command_data)
+    )
+    await asyncio.sleep(0)
+    # commands don't make a burst of messages
+    assert not middleware.has_pending_messages(100)
+
+    next_data = {}
+    next_message = asyncio.ensure_future(
+        middleware.on_pre_process_update(make_update(3, 100), next_data)
+    )
+    await asyncio.sleep(0)
+    assert middleware.has_pending_messages(100)
+
+    await middleware.on_post_process_update(make_update(1, 100), [], data)
+    await command
+    await middleware.on_post_process_update(make_update(2, 100), [], command_data)
+    await next_message
+    assert not middleware.has_pending_messages(100)
+    await middleware.on_post_process_update(make_update(3, 100), [], next_data)
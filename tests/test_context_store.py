@@ -0,0 +1,51 @@
+from bot.context_store import ContextStore
+
+
+def test_context_store_append_and_clear():
+    store = ContextStore(max_groups=10, max_bytes=10**6, max_messages=3)
+    assert store.get(1) is None
+    store.load(1, [("assistant", "Hi"), ("user", "Hello")])
+    store.append(1, "user", "How are you?")
+    store.append(1, "assistant", "Fine")
+    assert store.get(1) == [
+        ("assistant", "Fine"),
+        ("user", "How are you?"),
+        ("assistant", "Hi"),
+    ]
+    store.clear(1)
+    assert store.get(1) == []
+    assert store.stats()["hits"] == 2
+    assert store.stats()["misses"] == 1
+    assert store.size == 0
+
+
+def test_context_store_eviction():
+    store = ContextStore(max_groups=2, max_bytes=10**6)
+    for group_id in (1, 2):
+        store.get(group_id)
+        store.load(group_id, [("user", "Hello")])
+    # group 1 becomes recently used
+    store.get(1)
+    store.get(3)
+    store.load(3, [("user", "Hello")])
+    assert store.get(2) is None
+    assert len(store) == 2
+
+    store = ContextStore(max_bytes=store._message_size("x" * 100) * 2)
+    for group_id in (1, 2, 3):
+        store.get(group_id)
+        store.load(group_id, [("user", "x" * 100)])
+    assert len(store) == 2
+    assert store.get(1) is None
+
+
+def test_context_store_skips_stale_load():
+    store = ContextStore(max_bytes=10**6)
+    store.append(1, "user", "Not loaded")
+    assert store.get(1) is None
+    # message posted while the context is read from database
+    store.append(1, "assistant", "Broadcast")
+    store.load(1, [("user", "Old")])
+    assert store.get(1) is None
+    store.load(1, [("assistant", "Broadcast"), ("user", "Old")])
+    assert store.get(1) == [("assistant", "Broadcast"), ("user", "Old")]
@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import literal, select
+
+from bot.database import (
+    SessionExecutor,
+    engine,
+    pool_metrics,
+    run_in_session,
+    session_scope,
+)
+from bot.metrics import Histogram
+
+
+@pytest.mark.asyncio
+async def test_session_executor():
+    executor = SessionExecutor(max_workers=2, max_queue_size=2)
+
+    def query(db_session, value):
+        return db_session.execute(select(literal(value))).scalar()
+
+    assert await executor.run(query, 42) == 42
+    stats = executor.stats()
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+    assert stats["wait_time"]["count"] == 1
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_in_session():
+    @run_in_session
+    def query(db_session, value):
+        return db_session.execute(select(literal(value))).scalar()
+
+    assert await query(7) == 7
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.01, 0.1, 1))
+    for value in [0.005, 0.005, 0.05, 0.5]:
+        histogram.observe(value)
+    stats = histogram.stats()
+    assert stats["count"] == 4
+    assert stats["p50"] == 0.01
+    assert stats["p95"] == 0.5
+    assert stats["max"] == 0.5
+
+
+def test_pool_metrics():
+    checkouts = pool_metrics.checkout_wait.count
+    with session_scope() as db_session:
+        db_session.execute(select(literal(1)))
+        stats = pool_metrics.stats(engine.pool)
+        assert stats["checked_out"] >= 1
+    assert pool_metrics.checkout_wait.count == checkouts + 1
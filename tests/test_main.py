@@ -2,73 +2,193 @@ from unittest.mock import AsyncMock, call, patch
 
 import pytest
 from aiogram import types
+from aiogram.utils.exceptions import RetryAfter
+from sqlalchemy import delete
 
 from bot.bot_responses import responses
-from bot.main import handle_start
-from bot.models import User
+from bot.database import session_scope
+from bot.main import dp, send_streamed_response
+from bot.models import Message, User, user_group_rels
+from bot.openai_agent import ERROR_RESPONSE
 
-from .common import (  # noqa: F401
-    db_session,
-    fake_admin_bot,
-    fake_admin_dispatcher,
-    fake_bot,
-    fake_dispatcher,
-)
+from .common import fake_admin_bot, fake_bot  # noqa: F401
 
-mock_user = AsyncMock(id=123, username="testuser")
-mock_chat = AsyncMock(id=123)
+
+def make_update(text: str, update_id: int = 1) -> types.Update:
+    return types.Update(
+        **{
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": 123, "type": "private"},
+                "from": {
+                    "id": 123,
+                    "is_bot": False,
+                    "first_name": "Test",
+                    "username": "testuser",
+                },
+                "text": text,
+            },
+        }
+    )
+
+
+@pytest.fixture
+def registered_user():
+    """
+    Handlers commit in their own sessions, remove the user they create
+    """
+    yield 123
+    with session_scope() as db_session:
+        user = User.get_user_by_telegram_id(db_session, 123)
+        if user:
+            db_session.execute(
+                delete(Message).where(Message.group_id == user.private_group_id)
+            )
+            db_session.execute(
+                delete(user_group_rels).where(user_group_rels.c.user_id == user.id)
+            )
+            group = user.private_group
+            user.delete(db_session)
+            if group:
+                group.delete(db_session)
+    User.invalidate_principal(123)
 
 
 @pytest.mark.asyncio
-async def test_handle_start(
-    db_session,  # noqa: F811
-    fake_dispatcher,  # noqa: F811
-    fake_bot,  # noqa: F811
-    fake_admin_dispatcher,  # noqa: F811
-    fake_admin_bot,  # noqa: F811
-):
-    fake_message = types.Message()
-    fake_message.text = "/start"
-    fake_message.from_user = mock_user
-    fake_message.chat = mock_chat
-
-    with patch("bot.main.dp", fake_dispatcher), patch("bot.main.bot", fake_bot), patch(
-        "bot.main.admin_dp", fake_admin_dispatcher
-    ), patch("bot.main.admin_bot", fake_admin_bot):
-        await handle_start(fake_message, {"db_session": db_session})
+async def test_handle_start(registered_user, fake_bot, fake_admin_bot):  # noqa: F811
+    with patch("bot.main.bot", fake_bot), patch("bot.main.admin_bot", fake_admin_bot):
+        await dp.process_update(make_update("/start", 1))
 
     fake_bot.send_message.assert_has_calls(
         [
-            call(fake_message.chat.id, responses["handle"]["start"]["new"]),
+            call(123, responses["handle"]["start"]["new"]),
         ]
     )
+    fake_admin_bot.send_message.assert_called_once()
 
-    # TODO: fake_admin_bot.send_message.assert_called_once_with
+    with session_scope() as db_session:
+        user = User.get_user_by_telegram_id(db_session, registered_user)
+        assert user is not None
+        assert user.telegram_username == "testuser"
 
-    user = User.get_user_by_telegram_id(db_session, mock_user.id)
-    assert user is not None
-    assert user.telegram_username == "testuser"
-
-    with patch("bot.main.dp", fake_dispatcher), patch("bot.main.bot", fake_bot), patch(
-        "bot.main.admin_dp", fake_admin_dispatcher
-    ), patch("bot.main.admin_bot", fake_admin_bot):
-        await handle_start(fake_message, {"db_session": db_session})
+    with patch("bot.main.bot", fake_bot), patch("bot.main.admin_bot", fake_admin_bot):
+        await dp.process_update(make_update("/start", 2))
 
     fake_bot.send_message.assert_has_calls(
         [
-            call(fake_message.chat.id, responses["handle"]["start"]["inactive"]),
+            call(123, responses["handle"]["start"]["inactive"]),
         ]
     )
 
-    user.write(db_session, {"state": "banned"})
+    with session_scope() as db_session:
+        user = User.get_user_by_telegram_id(db_session, registered_user)
+        user.write(db_session, {"state": "banned"})
 
-    with patch("bot.main.dp", fake_dispatcher), patch("bot.main.bot", fake_bot), patch(
-        "bot.main.admin_dp", fake_admin_dispatcher
-    ), patch("bot.main.admin_bot", fake_admin_bot):
-        await handle_start(fake_message, {"db_session": db_session})
+    with patch("bot.main.bot", fake_bot), patch("bot.main.admin_bot", fake_admin_bot):
+        await dp.process_update(make_update("/start", 3))
 
     fake_bot.send_message.assert_has_calls(
         [
-            call(fake_message.chat.id, responses["handle"]["start"]["banned"]),
+            call(123, responses["handle"]["start"]["banned"]),
         ]
     )
+    fake_admin_bot.send_message.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_dispatch_help(fake_bot):  # noqa: F811
+    with patch("bot.main.bot", fake_bot):
+        await dp.process_update(make_update("/help"))
+
+    fake_bot.send_message.assert_called_once_with(123, responses["handle"]["help"])
+
+
+async def chunks(*texts):
+    for text in texts:
+        yield text
+
+
+@pytest.mark.asyncio
+async def test_send_streamed_response_throttles_edits(fake_bot):  # noqa: F811
+    placeholder = fake_bot.send_message.return_value
+    with patch("bot.main.bot", fake_bot), patch("bot.main.STREAM_EDIT_INTERVAL", 60):
+        text = await send_streamed_response(123, chunks("Hi", "Hi th", "Hi there"))
+
+    assert text == "Hi there"
+    fake_bot.send_message.assert_called_once_with(123, responses["stream_placeholder"])
+    # first text right away, the rest in the final edit
+    assert fake_bot.edit_message_text.call_args_list == [
+        call("Hi", 123, placeholder.message_id),
+        call("Hi there", 123, placeholder.message_id),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_streamed_response_retry_after(fake_bot):  # noqa: F811
+    placeholder = fake_bot.send_message.return_value
+    fake_bot.edit_message_text.side_effect = [RetryAfter(60), RetryAfter(0), None]
+    with patch("bot.main.bot", fake_bot), patch("bot.main.STREAM_EDIT_INTERVAL", 0):
+        text = await send_streamed_response(123, chunks("Hi", "Hi th", "Hi there"))
+
+    assert text == "Hi there"
+    # edits wait for flood control, the final edit is retried
+    assert fake_bot.edit_message_text.call_args_list == [
+        call("Hi", 123, placeholder.message_id),
+        call("Hi there", 123, placeholder.message_id),
+        call("Hi there", 123, placeholder.message_id),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_streamed_response_without_text(fake_bot):  # noqa: F811
+    placeholder = fake_bot.send_message.return_value
+    with patch("bot.main.bot", fake_bot):
+        text = await send_streamed_response(123, chunks(" "))
+
+    assert text == ERROR_RESPONSE
+    fake_bot.edit_message_text.assert_called_once_with(
+        ERROR_RESPONSE, 123, placeholder.message_id
+    )
+
+
+@pytest.mark.asyncio
+async def test_message_burst_gets_one_reply(registered_user, fake_bot):  # noqa: F811
+    with session_scope() as db_session:
+        User.create(
+            db_session,
+            {
+                "telegram_id": registered_user,
+                "telegram_username": "testuser",
+                "state": "active",
+            },
+        )
+    aprocess_message = AsyncMock(return_value="Answer")
+    with patch("bot.main.bot", fake_bot), patch(
+        "bot.main.CHAT_DEBOUNCE_WINDOW", 0.05
+    ), patch("bot.main.OPENAI_STREAM", False), patch(
+        "bot.main.openai_agent.aprocess_message", aprocess_message
+    ):
+        # the way long polling and webhook feed updates
+        await dp.process_updates(
+            [
+                make_update(text, update_id)
+                for update_id, text in [(1, "One"), (2, "Two"), (3, "Three")]
+            ]
+        )
+
+    # all messages are stored, the completion sees them merged
+    aprocess_message.assert_awaited_once()
+    (context,) = aprocess_message.call_args.args
+    assert [message["content"] for message in context[1:]] == ["One", "Two", "Three"]
+    fake_bot.send_message.assert_called_once_with(123, "Answer")
+    with session_scope() as db_session:
+        user = User.get_user_by_telegram_id(db_session, registered_user)
+        texts = [
+            message.text
+            for message in Message.search(
+                db_session, [("group_id", "=", user.private_group_id)], order="id asc"
+            )
+        ]
+    assert texts == ["One", "Two", "Three", "Answer"]
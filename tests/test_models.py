@@ -1,4 +1,8 @@
-from bot.models import Group, Message, User
+import pytest
+from sqlalchemy import event
+
+from bot.database import AsyncSessionLocal, get_async_engine
+from bot.models import BroadcastJob, Group, Message, User, domain_cache
 
 from .common import db_session  # noqa: F401
 
@@ -18,6 +22,9 @@ def test_create_user(db_session):  # noqa: F811
     user = create_user(db_session)
     assert user is not None
     assert user.telegram_id == 123456
+    assert user.get_private_group(db_session).type == "private"
+    assert user.private_group_id == user.get_private_group(db_session).id
+    assert user in user.get_private_group(db_session).users
 
 
 def test_get_user_by_telegram_id(db_session):  # noqa: F811
@@ -27,6 +34,12 @@ def test_get_user_by_telegram_id(db_session):  # noqa: F811
     assert user.telegram_username == "testuser"
 
 
+def test_get_user_by_telegram_username(db_session):  # noqa: F811
+    user = create_user(db_session)
+    assert User.get_user_by_telegram_username(db_session, "testuser") == user
+    assert User.get_user_by_telegram_username(db_session, "nobody") is None
+
+
 def test_update_user(db_session):  # noqa: F811
     user = create_user(db_session)
     updated_data = {"telegram_username": "updateduser"}
@@ -57,3 +70,168 @@ def test_reset_context(db_session):  # noqa: F811
     assert len(group.context_messages) == 1
     group.reset_context(db_session)
     assert len(group.context_messages) == 0
+
+
+def test_reset_context_keeps_history(db_session):  # noqa: F811
+    user = create_user(db_session)
+    group = Group.create(db_session, {"title": "Test Group"})
+    Message.post(db_session, text="Old Message", author=user, group=group)
+    group.reset_context(db_session)
+    Message.post(db_session, text="New Message", author=user, group=group)
+    context = group.get_format_context(db_session)
+    assert [message["content"] for message in context[1:]] == ["New Message"]
+    assert len(group.messages) == 2
+
+
+def test_get_format_context_token_limit(db_session):  # noqa: F811
+    user = create_user(db_session)
+    group = Group.create(db_session, {"title": "Test Group"})
+    for text in ["First message " * 20, "Second message", "Third message"]:
+        Message.post(db_session, text=text, author=user, group=group)
+
+    context = group.get_format_context(db_session)
+    assert [message["role"] for message in context] == ["system"] + ["user"] * 3
+
+    context = group.get_format_context(db_session, token_limit=40)
+    assert [message["content"] for message in context[1:]] == [
+        "Second message",
+        "Third message",
+    ]
+
+    context = group.get_format_context(db_session, token_limit=0)
+    assert [message["content"] for message in context[1:]] == ["Third message"]
+
+
+def count_context_queries(db_session, group) -> int:  # noqa: F811
+    """
+    Return number of statements loading context of the group
+    """
+    db_session.expire_all()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        group.get_format_context(db_session)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
+
+
+def test_context_query_count(db_session):  # noqa: F811
+    group = Group.create(db_session, {"title": "Test Group"})
+    messages = [{"text": "Message", "group_id": group.id}] * 10
+    Message.create_multi(db_session, messages)
+    queries = count_context_queries(db_session, group)
+    Message.create_multi(db_session, messages)
+    # the number of queries doesn't grow with the conversation
+    assert count_context_queries(db_session, group) == queries
+    assert len(group.get_format_context(db_session)) == 21
+
+
+def test_get_principal(db_session):  # noqa: F811
+    user = create_user(db_session)
+    principal = User.get_principal(db_session, user.telegram_id)
+    assert principal.id == user.id
+    assert principal.state == "active"
+    assert principal.private_group_id == user.get_private_group(db_session).id
+
+    user.write(db_session, {"state": "banned"})
+    assert User.get_principal(db_session, user.telegram_id).state == "active"
+    User.invalidate_principal(user.telegram_id)
+    assert User.get_principal(db_session, user.telegram_id).state == "banned"
+    # only active users are cached
+    assert User.get_cached_principal(user.telegram_id) is None
+    user.write(db_session, {"state": "active"})
+    assert User.get_principal(db_session, user.telegram_id).state == "active"
+    User.invalidate_principal(user.telegram_id)
+
+
+def test_broadcast_jobs(db_session):  # noqa: F811
+    first = BroadcastJob.create(db_session, {"text": "First"})
+    second = BroadcastJob.create(db_session, {"text": "Second"})
+    BroadcastJob.create(db_session, {"text": "Done", "state": "done"})
+    active_jobs = BroadcastJob.get_active_jobs(db_session)
+    assert [job.id for job in active_jobs][-2:] == [first.id, second.id]
+    assert BroadcastJob.get_last_job(db_session).text == "Done"
+    assert second.get_status()["state"] == "pending"
+
+
+def test_search_domain(db_session):  # noqa: F811
+    first = Group.create(db_session, {"title": "First Group"})
+    second = Group.create(db_session, {"title": "Second Group"})
+    domain = [("title", "like", "% Group"), ("id", "in", [first.id, second.id])]
+    assert Group.search(db_session, domain, order="id asc") == [first, second]
+    assert len(domain) == 2
+
+    domain_cache.clear()
+    hits = domain_cache.hits
+    domain = ["|", ("id", "=", first.id), ("title", "=", None)]
+    assert Group.search(db_session, domain) == [first]
+    domain = ["|", ("id", "=", second.id), ("title", "=", None)]
+    assert Group.search(db_session, domain) == [second]
+    assert domain_cache.hits == hits + 1
+
+
+def test_search_read(db_session):  # noqa: F811
+    user = create_user(db_session)
+    rows = User.search_read(
+        db_session, [("telegram_id", "=", user.telegram_id)], ["id", "state"]
+    )
+    assert rows == [(user.id, "active")]
+    assert rows[0].state == "active"
+
+    groups = [Group.create(db_session, {"title": f"Read {i}"}) for i in range(3)]
+    rows = Group.search_read(
+        db_session,
+        [("title", "like", "Read %")],
+        ["title"],
+        limit=2,
+        order="id desc",
+        offset=1,
+    )
+    assert [row.title for row in rows] == [groups[1].title, groups[0].title]
+
+
+def test_iter_search(db_session):  # noqa: F811
+    groups = [Group.create(db_session, {"title": f"Iter {i}"}) for i in range(5)]
+    found = Group.iter_search(db_session, [("title", "like", "Iter %")], batch_size=2)
+    assert [group.id for group in found] == [group.id for group in groups]
+
+
+def test_search_count_exists(db_session):  # noqa: F811
+    for i in range(3):
+        Group.create(db_session, {"title": f"Count {i}"})
+    assert Group.search_count(db_session, [("title", "like", "Count %")]) == 3
+    assert Group.search_exists(db_session, [("title", "=", "Count 1")])
+    assert not Group.search_exists(db_session, [("title", "=", "Count 3")])
+
+
+def test_create_write_multi(db_session):  # noqa: F811
+    ids = Group.create_multi(
+        db_session, [{"title": f"Bulk {i}"} for i in range(5)], batch_size=2
+    )
+    assert len(ids) == 5
+    assert Group.search_count(db_session, [("id", "in", ids)]) == 5
+
+    assert Group.write_multi(db_session, ids[:3], {"title": "Bulk updated"}) == 3
+    groups = Group.search(db_session, [("title", "=", "Bulk updated")])
+    assert sorted(group.id for group in groups) == ids[:3]
+    assert Group.write_multi(db_session, [], {"title": "Nothing"}) == 0
+
+
+@pytest.mark.asyncio
+async def test_async_crud():
+    get_async_engine()
+    async with AsyncSessionLocal() as session:
+        group = await Group.acreate(session, {"title": "Async Group"})
+        assert await Group.asearch(session, [("id", "=", group.id)]) == [group]
+        await group.awrite(session, {"title": "Updated Async Group"})
+        groups = await Group.asearch(session, [("title", "=", "Updated Async Group")])
+        assert [g.id for g in groups] == [group.id]
+        await group.adelete(session)
+        assert await Group.asearch(session, [("id", "=", group.id)]) == []
+        await session.rollback()
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from bot.openai_agent import ERROR_RESPONSE, TRUNCATED_RESPONSE, OpenAIAgent
+
+settings = {"model": "gpt-3.5-turbo", "temperature": 0, "max_tokens": 300}
+conversation = [
+    {"role": "system", "content": "The assistant is helpful."},
+    {"role": "user", "content": "привет"},
+]
+
+
+def completion(text):
+    message = SimpleNamespace(content=text)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.mark.asyncio
+async def test_response_cache():
+    agent = OpenAIAgent(api_key="test", settings=settings, cache_size=10)
+    acreate = AsyncMock(return_value=completion("Привет!"))
+    with patch("openai.ChatCompletion.acreate", acreate):
+        assert await agent.aget_ai_response(conversation) == "Привет!"
+        assert await agent.aget_ai_response(list(conversation)) == "Привет!"
+    await agent.close()
+    assert acreate.call_count == 1
+    assert agent.response_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_response_cache_skips_errors():
+    agent = OpenAIAgent(api_key="test", settings=settings, cache_size=10)
+    with patch("openai.ChatCompletion.acreate", AsyncMock(side_effect=Exception)):
+        assert await agent.aget_ai_response(conversation) == ERROR_RESPONSE
+    await agent.close()
+    assert len(agent.response_cache) == 0
+
+
+def test_response_cache_disabled_for_sampling():
+    sampled = dict(settings, temperature=0.8)
+    assert OpenAIAgent("test", settings=sampled, cache_size=10).response_cache is None
+    agent = OpenAIAgent(
+        "test", settings=sampled, cache_size=10, cache_nondeterministic=True
+    )
+    assert agent.response_cache is not None
+    assert OpenAIAgent("test", settings=settings).response_cache is None
+
+
+def stream(*deltas, error=None):
+    async def chunks():
+        for delta in deltas:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta={"content": delta})])
+        if error:
+            raise error
+
+    return AsyncMock(return_value=chunks())
+
+
+async def collect(agent, conversation):
+    return [text async for text in agent.astream_ai_response(conversation)]
+
+
+@pytest.mark.asyncio
+async def test_stream_response():
+    agent = OpenAIAgent(api_key="test", settings=settings, cache_size=10)
+    with patch("openai.ChatCompletion.acreate", stream("При", "вет", "!")):
+        assert await collect(agent, conversation) == ["При", "Привет", "Привет!"]
+    # the complete answer is cached and yielded at once
+    assert await collect(agent, conversation) == ["Привет!"]
+    await agent.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_response_errors():
+    agent = OpenAIAgent(api_key="test", settings=settings, cache_size=10)
+    with patch("openai.ChatCompletion.acreate", stream()):
+        assert await collect(agent, conversation) == [ERROR_RESPONSE]
+    interrupted = stream("При", error=RuntimeError)
+    with patch("openai.ChatCompletion.acreate", interrupted):
+        assert await collect(agent, conversation) == [
+            "При",
+            "При" + TRUNCATED_RESPONSE,
+        ]
+    await agent.close()
+    assert len(agent.response_cache) == 0
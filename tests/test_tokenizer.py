@@ -0,0 +1,18 @@
+from unittest.mock import MagicMock, patch
+
+from bot.tokenizer import ApproximateTokenizer, TiktokenTokenizer, get_tokenizer
+
+
+def test_tokenizer_requires_local_cache(tmp_path, monkeypatch):
+    tiktoken = MagicMock()
+    with patch("bot.tokenizer.tiktoken", tiktoken):
+        monkeypatch.delenv("TIKTOKEN_CACHE_DIR", raising=False)
+        assert isinstance(get_tokenizer("gpt-4"), ApproximateTokenizer)
+        # empty cache would make tiktoken download the encoding
+        monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+        assert isinstance(get_tokenizer("gpt-4"), ApproximateTokenizer)
+        tiktoken.encoding_for_model.assert_not_called()
+
+        (tmp_path / "9b5ad71b2ce5302211f9c61530b329a4922fc6a4").write_bytes(b"")
+        assert isinstance(get_tokenizer("gpt-4"), TiktokenTokenizer)
+        tiktoken.encoding_for_model.assert_called_once_with("gpt-4")
@@ -0,0 +1,110 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from aiogram import Bot, Dispatcher
+from fastapi.testclient import TestClient
+
+from bot.chat_queue import ChatQueueMiddleware
+from bot.webhook import app
+
+from .common import fake_bot, fake_dispatcher  # noqa: F401
+
+update = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 123, "type": "private"},
+        "from": {"id": 123, "is_bot": False, "first_name": "Test"},
+        "text": "Hello",
+    },
+}
+
+headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+
+
+def test_webhook_feeds_update_to_dispatcher(fake_dispatcher):  # noqa: F811
+    client = TestClient(app)
+    process_update = AsyncMock()
+    with patch("bot.webhook.WEBHOOK_SECRET", "secret"), patch(
+        "bot.webhook.DISPATCHERS", {"main": fake_dispatcher}
+    ), patch("bot.webhook.process_update", process_update):
+        response = client.post("/webhook/main", json=update, headers=headers)
+
+    assert response.status_code == 200
+    process_update.assert_called_once()
+    dispatcher, received_update = process_update.call_args.args
+    assert dispatcher is fake_dispatcher
+    assert received_update.message.text == "Hello"
+
+
+def test_webhook_rejects_invalid_requests(fake_dispatcher):  # noqa: F811
+    client = TestClient(app)
+    process_update = AsyncMock()
+    with patch("bot.webhook.WEBHOOK_SECRET", "secret"), patch(
+        "bot.webhook.DISPATCHERS", {"main": fake_dispatcher}
+    ), patch("bot.webhook.process_update", process_update):
+        response = client.post(
+            "/webhook/main",
+            json=update,
+            headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+        )
+        assert response.status_code == 403
+        response = client.post("/webhook/unknown", json=update, headers=headers)
+        assert response.status_code == 404
+
+    process_update.assert_not_called()
+
+
+def test_webhook_requires_configured_secret(fake_dispatcher):  # noqa: F811
+    client = TestClient(app)
+    process_update = AsyncMock()
+    with patch("bot.webhook.WEBHOOK_SECRET", None), patch(
+        "bot.webhook.DISPATCHERS", {"main": fake_dispatcher}
+    ), patch("bot.webhook.process_update", process_update):
+        response = client.post("/webhook/main", json=update)
+        assert response.status_code == 403
+        response = client.post(
+            "/webhook/main",
+            json=update,
+            headers={"X-Telegram-Bot-Api-Secret-Token": ""},
+        )
+        assert response.status_code == 403
+
+    process_update.assert_not_called()
+
+
+def test_webhook_processes_chat_updates_in_order():
+    dispatcher = Dispatcher(Bot(token="123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"))
+    dispatcher.middleware.setup(ChatQueueMiddleware())
+    events = []
+
+    @dispatcher.message_handler()
+    async def handle_message(message):
+        events.append(("start", message.message_id))
+        await asyncio.sleep(0.05)
+        events.append(("end", message.message_id))
+
+    with patch("bot.webhook.WEBHOOK_SECRET", "secret"), patch(
+        "bot.webhook.DISPATCHERS", {"main": dispatcher}
+    ), patch("bot.webhook.init_db"), patch(
+        "bot.webhook.openai_agent", AsyncMock()
+    ), patch(
+        "bot.webhook.broadcast_worker", MagicMock(run=AsyncMock())
+    ), patch(
+        "bot.webhook.flush_messages", AsyncMock()
+    ):
+        # shutdown of the client waits for updates processed in background
+        with TestClient(app) as client:
+            for update_id in [1, 2]:
+                chat_update = dict(
+                    update,
+                    update_id=update_id,
+                    message=dict(update["message"], message_id=update_id),
+                )
+                response = client.post(
+                    "/webhook/main", json=chat_update, headers=headers
+                )
+                assert response.status_code == 200
+
+    assert events == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
@@ -0,0 +1,68 @@
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from bot.models import Group, Message
+from bot.write_behind import MessageWriteBehind
+
+from .common import db_session  # noqa: F401
+from .test_models import create_user
+
+
+def test_write_behind_context(db_session):  # noqa: F811
+    user = create_user(db_session)
+    group = Group.create(db_session, {"title": "Test Group"})
+    Message.post(db_session, text="Stored", author=user, group=group)
+    message_queue = MessageWriteBehind(batch_size=2)
+    message_queue.add("Question", group.id, user.id, user.role)
+    message_queue.add("Answer", group.id)
+
+    assert len(message_queue.pending(group.id)) == 2
+    context = group.get_format_context(db_session, message_queue=message_queue)
+    assert [message["content"] for message in context[1:]] == [
+        "Stored",
+        "Question",
+        "Answer",
+    ]
+    assert context[-1]["role"] == "assistant"
+
+    # the test transaction is rolled back instead
+    with patch.object(db_session, "commit"):
+        assert message_queue.flush(db_session) == 2
+    assert len(message_queue) == 0
+    assert len(group.messages) == 3
+    context = group.get_format_context(db_session, message_queue=message_queue)
+    assert len(context) == 4
+
+
+def test_write_behind_keeps_messages_on_error(db_session):  # noqa: F811
+    message_queue = MessageWriteBehind()
+    message = message_queue.add("Lost group", group_id=None, user_id=-1)
+    with patch("bot.write_behind.Message.create_multi", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            message_queue.flush(db_session)
+    assert len(message_queue) == 1
+    assert message.id is None
+
+
+def test_write_behind_drops_rejected_messages(db_session):  # noqa: F811
+    message_queue = MessageWriteBehind()
+    rejected = message_queue.add("Unknown user", group_id=None, user_id=-1)
+    kept = message_queue.add("Answer", group_id=None)
+    with patch.object(db_session, "commit"):
+        assert message_queue.flush(db_session) == 1
+    assert len(message_queue) == 0
+    assert message_queue.dropped == 1
+    assert rejected.id is None
+    assert kept.id is not None
+
+
+@pytest.mark.asyncio
+async def test_write_behind_put_flushes_full_queue():
+    message_queue = MessageWriteBehind(max_size=2)
+    executor = AsyncMock()
+    await message_queue.put(executor, "First", group_id=1)
+    await message_queue.put(executor, "Second", group_id=1)
+    executor.run.assert_not_called()
+    await message_queue.put(executor, "Third", group_id=1)
+    executor.run.assert_called_once_with(message_queue.flush)